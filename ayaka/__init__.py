@@ -6,8 +6,9 @@ from .init import DONT_USE_ME as __DONT_USE_ME
 
 # ---- ayaka box ----
 from .box import AyakaBox
+from .args import AyakaArgs
 from .config import AyakaConfig
-from .helpers import Timer, get_user, do_nothing, singleton, run_in_startup, slow_load_config,  load_data_from_file, resource_download, ensure_dir_exists, resource_download_by_res_info, ResInfo, ResItem, get_file_hash
+from .helpers import Timer, LRUCache, get_user, do_nothing, singleton, run_in_startup, slow_load_config,  load_data_from_file, resource_download, ensure_dir_exists, resource_download_by_res_info, ResInfo, ResItem, get_file_hash
 
 # ---- 未来将被sqlmodel取代 ----
 from .orm import AyakaDB, AyakaGroupDB, AyakaUserDB
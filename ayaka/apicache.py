@@ -0,0 +1,142 @@
+'''OneBot API 结果缓存
+
+通过bot的on_calling_api、on_called_api钩子，缓存根配置api_cache中列出的只读API的结果，对所有bot与插件透明生效；api_cache默认为空，即不启用
+
+- 缓存未过期时，直接返回缓存的结果，不再请求协议端
+- 同一bot以相同参数并发调用同一API时，只请求一次，其他调用者等待同一个结果
+- 调用失败的结果不会被缓存
+- 每个调用者得到缓存结果的副本，修改它不会影响缓存
+'''
+import asyncio
+from copy import deepcopy
+from typing import Any, Hashable
+from nonebot.exception import MockApiException
+from .config import ayaka_root_config
+from .helpers import LRUCache
+from .lazy import Bot
+
+
+class AyakaApiCache:
+    '''OneBot API 结果缓存
+
+    参数:
+
+        ttls: API名 → 缓存时间（秒），为0时永不过期
+
+        maxsize: 每个API最多缓存的结果数，为0时不限制
+
+        timeout: 等待其他调用者结果的最长时间（秒），超时后自行调用
+
+    钩子只使用bot的self_id，因此可以脱离nonebot，以任意带有self_id的对象直接测试
+
+    示例代码:
+    ```
+        cache = AyakaApiCache({"get_group_info": 60})
+        bot = SimpleNamespace(self_id="1")
+        data = {"group_id": 1}
+        await cache.on_calling(bot, "get_group_info", data)
+        await cache.on_called(bot, None, "get_group_info", data, {"group_name": "x"})
+        # 再次调用时以MockApiException返回结果的副本
+        await cache.on_calling(bot, "get_group_info", {"group_id": 1})
+    ```
+    '''
+
+    def __init__(self, ttls: dict[str, float], maxsize: int = 0, timeout: float = 30) -> None:
+        self.timeout = timeout
+        self.caches: dict[str, LRUCache[Hashable, Any]] = {
+            api: LRUCache(maxsize, ttl) for api, ttl in ttls.items()
+        }
+        '''API名 → 缓存'''
+        self.inflight: dict[Hashable, tuple[dict, asyncio.Future]] = {}
+        '''正在请求的调用 → (发起者的参数, 结果)'''
+        self.coalesced = 0
+        '''等待其他调用者结果的次数'''
+
+    def get_key(self, bot: Bot, api: str, data: dict):
+        '''生成缓存的键，不应缓存时返回None'''
+        if api not in self.caches or data.get("no_cache"):
+            return
+        key = (bot.self_id, api, tuple(sorted(data.items())))
+        try:
+            hash(key)
+        except TypeError:
+            return
+        return key
+
+    async def on_calling(self, bot: Bot, api: str, data: dict):
+        '''调用API前，命中缓存或已有相同的调用时，以MockApiException返回其结果'''
+        key = self.get_key(bot, api, data)
+        if key is None:
+            return
+
+        result = self.caches[api].get(key)
+        if result is not None:
+            raise MockApiException(deepcopy(result))
+
+        item = self.inflight.get(key)
+        if item is None:
+            self.inflight[key] = (data, asyncio.get_running_loop().create_future())
+            return
+
+        self.coalesced += 1
+        try:
+            result = await asyncio.wait_for(asyncio.shield(item[1]), self.timeout)
+        except asyncio.TimeoutError:
+            # 发起者可能已被取消，不会再返回结果
+            if self.inflight.get(key) is item:
+                self.inflight.pop(key)
+            return
+        except Exception:
+            # 发起者失败时，自行调用
+            return
+        raise MockApiException(deepcopy(result))
+
+    async def on_called(self, bot: Bot, exception: Exception | None, api: str, data: dict, result: Any):
+        '''调用API后，缓存成功的结果，并通知等待该结果的调用者'''
+        key = self.get_key(bot, api, data)
+        if key is None:
+            return
+
+        # 只处理发起者自身的调用，命中缓存或等待其他调用者的调用也会经过该钩子
+        item = self.inflight.get(key)
+        if item is None or item[0] is not data:
+            return
+        self.inflight.pop(key)
+        future = item[1]
+
+        if exception:
+            future.set_exception(exception)
+            # 没有其他调用者等待时，避免asyncio警告异常未被获取
+            future.exception()
+            return
+        if result is not None:
+            # 发起者得到的结果可能被修改，缓存其副本
+            result = deepcopy(result)
+            self.caches[api].put(key, result)
+        future.set_result(result)
+
+    def invalidate(self, api: str | None = None):
+        '''清除某个API或全部API的缓存'''
+        for name, cache in self.caches.items():
+            if api is None or name == api:
+                cache.clear()
+
+    def stats(self):
+        '''返回各API的缓存统计'''
+        return {
+            "coalesced": self.coalesced,
+            "inflight": len(self.inflight),
+            "apis": {api: cache.stats() for api, cache in self.caches.items()},
+        }
+
+
+ayaka_api_cache = AyakaApiCache(
+    ayaka_root_config.api_cache,
+    ayaka_root_config.api_cache_max_size,
+    ayaka_root_config.api_cache_timeout
+)
+'''ayaka OneBot API 结果缓存'''
+
+if ayaka_api_cache.caches:
+    Bot.on_calling_api(ayaka_api_cache.on_calling)
+    Bot.on_called_api(ayaka_api_cache.on_called)
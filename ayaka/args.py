@@ -0,0 +1,140 @@
+'''命令参数解析
+
+一次遍历消息，根据配置的分割符（command_sep）分割文本，引号内的文本视为一个参数，at等非文本消息段各自视为一个参数
+
+解析结果为AyakaArgs，它是一个列表，同时提供按类型读取参数的方法
+'''
+import re
+from .helpers import get_user, singleton
+from .lazy import Message, MessageSegment, get_driver
+
+QUOTES = {'"': '"', "'": "'", "“": "”", "‘": "’"}
+'''引号 → 对应的右引号'''
+
+
+@singleton
+def get_pattern():
+    '''生成分割文本的正则表达式
+
+    依次尝试匹配各种引号包围的文本，否则匹配到下一个分割符为止；分割符本身不被任何分支匹配，因此被跳过'''
+    seps = sorted(get_driver().config.command_sep, key=len, reverse=True)
+    quoted = [
+        f"{re.escape(left)}([^{re.escape(right)}]*){re.escape(right)}"
+        for left, right in QUOTES.items()
+    ]
+    if seps:
+        sep = "|".join(re.escape(sep) for sep in seps)
+        plain = f"(?:(?!{sep}).)+"
+    else:
+        plain = ".+"
+    return re.compile("|".join([*quoted, plain]), re.S)
+
+
+class AyakaArgs(list):
+    '''分割后的参数，元素为str或非文本的MessageSegment
+
+    参数:
+
+        items: 参数
+
+        spans: 各参数在消息中的位置，(消息段序号, 文本中的起始位置)
+
+        message: 被分割的消息
+    '''
+
+    def __init__(self, items: list[str | MessageSegment], spans: list[tuple[int, int]], message: Message) -> None:
+        super().__init__(items)
+        self.spans = spans
+        self.message = message
+
+    def get(self, i: int, default=None):
+        '''获取第i个参数，不存在时返回default'''
+        if -len(self) <= i < len(self):
+            return self[i]
+        return default
+
+    def get_str(self, i: int, default: str = "") -> str:
+        '''获取第i个参数的文本，不存在或不是文本时返回default'''
+        item = self.get(i)
+        return item if isinstance(item, str) else default
+
+    def get_int(self, i: int, default: int | None = None) -> int | None:
+        '''将第i个参数转换为int，失败时返回default'''
+        try:
+            return int(self.get_str(i))
+        except ValueError:
+            return default
+
+    def get_float(self, i: int, default: float | None = None) -> float | None:
+        '''将第i个参数转换为float，失败时返回default'''
+        try:
+            return float(self.get_str(i))
+        except ValueError:
+            return default
+
+    def get_user_id(self, i: int, default: int | None = None) -> int | None:
+        '''将第i个参数视为用户，支持at消息段、qq号、@qq号，失败时返回default
+
+        需要通过群名片或昵称查找用户时，请使用get_user'''
+        item = self.get(i)
+        if isinstance(item, MessageSegment):
+            if item.type == "at" and str(item.data.get("qq", "")).isdigit():
+                return int(item.data["qq"])
+            return default
+        if isinstance(item, str):
+            text = item[1:] if item.startswith("@") else item
+            if text.isdigit():
+                return int(text)
+        return default
+
+    def get_user(self, i: int, users: list):
+        '''在users中查找第i个参数对应的用户，支持at消息段、qq号、@昵称、昵称，失败时返回None
+
+        参数:
+
+            users: 群成员列表或AyakaMemberIndex，可通过box.get_members获取
+        '''
+        item = self.get(i)
+        if item is None:
+            return
+        if isinstance(item, str):
+            item = MessageSegment.text(item)
+        return get_user(item, users)
+
+    def get_rest(self, i: int) -> Message:
+        '''获取第i个参数及其之后的原始消息，保留原有的分割符与引号'''
+        if not -len(self) <= i < len(self):
+            return Message()
+        index, start = self.spans[i]
+        rest = Message()
+        for j, segment in enumerate(self.message[index:]):
+            if j == 0 and segment.is_text():
+                segment = MessageSegment.text(str(segment)[start:])
+            rest.append(segment)
+        return rest
+
+    def get_text(self, i: int) -> str:
+        '''获取第i个参数及其之后的原始文本'''
+        return str(self.get_rest(i))
+
+
+def tokenize(message: Message) -> AyakaArgs:
+    '''一次遍历消息，分割为参数'''
+    pattern = get_pattern()
+    items: list[str | MessageSegment] = []
+    spans: list[tuple[int, int]] = []
+    for index, segment in enumerate(message):
+        if not segment.is_text():
+            items.append(segment)
+            spans.append((index, 0))
+            continue
+
+        for match in pattern.finditer(str(segment)):
+            # 引号分支匹配成功时，取引号内的文本
+            text = next(
+                (g for g in match.groups() if g is not None),
+                match.group()
+            )
+            items.append(text)
+            spans.append((index, match.start()))
+    return AyakaArgs(items, spans, message)
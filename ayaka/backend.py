@@ -0,0 +1,287 @@
+'''状态后端
+
+保存各群聊的当前盒子、各盒子在各群聊的状态、私聊监听，并为盒子创建群聊数据缓存
+
+可在nonebot的配置中设置:
+
+    ayaka_state_backend: memory（默认，保存在进程内）或sqlite（保存在data/ayaka/state.db，可被多个进程共享）
+
+    ayaka_worker_count: 共同运行的ayaka进程数，默认为1
+
+    ayaka_worker_index: 当前进程的序号，从0开始
+
+多个进程连接同一个bot账号时，每个群聊只由group_id % ayaka_worker_count == ayaka_worker_index的进程处理，因此群聊的状态和缓存只会被一个进程修改；私聊监听则通过共享的后端在进程之间同步
+'''
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from time import time
+from .boxcache import AyakaBoxCache
+from .config import data_path
+from .lazy import get_driver, logger
+
+
+class AyakaStateBackend(ABC):
+    '''状态后端，继承时请实现除owns、create_cache以外的方法
+
+    参数:
+
+        worker_index: 当前进程的序号
+
+        worker_count: 共同运行的进程数
+    '''
+
+    def __init__(self, worker_index: int = 0, worker_count: int = 1) -> None:
+        if not 0 <= worker_index < worker_count:
+            raise Exception(
+                f"ayaka_worker_index {worker_index} 必须位于 [0, {worker_count}) 之间")
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+
+    def owns(self, group_id: int):
+        '''该群聊是否由当前进程处理'''
+        return group_id % self.worker_count == self.worker_index
+
+    def create_cache(self, box_name: str):
+        '''为盒子创建群聊数据缓存
+
+        缓存中的对象只存在于当前进程，由于每个群聊只由一个进程处理，它们不会出现不一致；被淘汰的对象转存在共享的数据库中'''
+        return AyakaBoxCache(
+            box_name, lambda group_id: self.get_current_box(group_id) == box_name)
+
+    @abstractmethod
+    def get_current_box(self, group_id: int) -> str:
+        '''获取群聊的当前盒子名，不存在时返回空字符串'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_current_box(self, group_id: int, box_name: str):
+        '''设置群聊的当前盒子名，为空字符串时清除'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_state(self, box_name: str, group_id: int) -> str:
+        '''获取盒子在群聊的状态，默认为idle'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_state(self, box_name: str, group_id: int, state: str):
+        '''设置盒子在群聊的状态'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_listeners(self, user_id: int) -> list[int]:
+        '''获取正在监听该私聊且未过期的群聊'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_listener(self, user_id: int, group_id: int, expire: float = 0):
+        '''令群聊监听私聊
+
+        参数:
+
+            expire: 过期的时间戳，为0时永不过期
+        '''
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_listener(self, user_id: int, group_id: int):
+        '''令群聊取消监听私聊'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_listeners(self, group_id: int):
+        '''令群聊取消所有监听'''
+        raise NotImplementedError
+
+
+class AyakaMemoryBackend(AyakaStateBackend):
+    '''保存在进程内的状态后端'''
+
+    def __init__(self, worker_index: int = 0, worker_count: int = 1) -> None:
+        super().__init__(worker_index, worker_count)
+        self.current: dict[int, str] = {}
+        '''群聊 → 当前盒子名'''
+        self.states: dict[str, dict[int, str]] = {}
+        '''盒子名 → 群聊 → 状态'''
+        self.listeners: dict[int, dict[int, float]] = {}
+        '''私聊 → 监听它的群聊 → 过期时间戳'''
+        self.listened: dict[int, set[int]] = {}
+        '''群聊 → 它监听的私聊'''
+
+    def get_current_box(self, group_id: int):
+        return self.current.get(group_id, "")
+
+    def set_current_box(self, group_id: int, box_name: str):
+        if box_name:
+            self.current[group_id] = box_name
+        else:
+            self.current.pop(group_id, None)
+
+    def get_state(self, box_name: str, group_id: int):
+        return self.states.get(box_name, {}).get(group_id, "idle")
+
+    def set_state(self, box_name: str, group_id: int, state: str):
+        self.states.setdefault(box_name, {})[group_id] = state
+
+    def get_listeners(self, user_id: int):
+        group_ids = self.listeners.get(user_id)
+        if not group_ids:
+            return []
+
+        now = time()
+        expired = [
+            group_id for group_id, expire in group_ids.items()
+            if expire and expire <= now
+        ]
+        for group_id in expired:
+            self.remove_listener(user_id, group_id)
+        return list(group_ids)
+
+    def add_listener(self, user_id: int, group_id: int, expire: float = 0):
+        self.listeners.setdefault(user_id, {})[group_id] = expire
+        self.listened.setdefault(group_id, set()).add(user_id)
+
+    def remove_listener(self, user_id: int, group_id: int):
+        group_ids = self.listeners.get(user_id)
+        if not group_ids or group_id not in group_ids:
+            return
+        group_ids.pop(group_id)
+        if not group_ids:
+            self.listeners.pop(user_id)
+
+        user_ids = self.listened[group_id]
+        user_ids.discard(user_id)
+        if not user_ids:
+            self.listened.pop(group_id)
+
+    def remove_listeners(self, group_id: int):
+        for user_id in list(self.listened.get(group_id, ())):
+            self.remove_listener(user_id, group_id)
+
+
+class AyakaSqliteBackend(AyakaStateBackend):
+    '''保存在sqlite中的状态后端，WAL模式下多个进程可以同时读写
+
+    每次修改立即提交，以便其他进程可见；群聊的当前盒子和状态只会被处理该群聊的进程修改，因此在本进程内缓存读取结果
+
+    参数:
+
+        path: 数据库文件地址
+    '''
+
+    def __init__(self, path: str, worker_index: int = 0, worker_count: int = 1) -> None:
+        super().__init__(worker_index, worker_count)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None, timeout=5)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript('''
+            create table if not exists ayaka_current_box (
+                group_id integer primary key, box_name text);
+            create table if not exists ayaka_box_state (
+                box_name text, group_id integer, state text,
+                primary key (box_name, group_id));
+            create table if not exists ayaka_listener (
+                user_id integer, group_id integer, expire real default 0,
+                primary key (user_id, group_id));
+            create index if not exists ayaka_listener_group on ayaka_listener (group_id);
+        ''')
+        self._migrate()
+        self.current: dict[int, str] = {}
+        self.states: dict[tuple[str, int], str] = {}
+
+    def _migrate(self):
+        '''为旧版数据库中的表补充新增的列'''
+        columns = [row[1] for row in self.db.execute(
+            "PRAGMA table_info(ayaka_listener)")]
+        if "expire" not in columns:
+            self.db.execute(
+                "ALTER TABLE ayaka_listener ADD COLUMN expire real default 0")
+
+    def _execute(self, query: str, values=()):
+        with self.lock:
+            self.db.execute(query, values)
+
+    def _fetchall(self, query: str, values=()):
+        with self.lock:
+            return self.db.execute(query, values).fetchall()
+
+    def get_current_box(self, group_id: int):
+        box_name = self.current.get(group_id)
+        if box_name is None:
+            rows = self._fetchall(
+                "select box_name from ayaka_current_box where group_id=?", (group_id,))
+            box_name = rows[0][0] if rows else ""
+            self.current[group_id] = box_name
+        return box_name
+
+    def set_current_box(self, group_id: int, box_name: str):
+        if self.get_current_box(group_id) == box_name:
+            return
+        self.current[group_id] = box_name
+        if box_name:
+            self._execute(
+                "replace into ayaka_current_box values (?,?)", (group_id, box_name))
+        else:
+            self._execute(
+                "delete from ayaka_current_box where group_id=?", (group_id,))
+
+    def get_state(self, box_name: str, group_id: int):
+        key = (box_name, group_id)
+        state = self.states.get(key)
+        if state is None:
+            rows = self._fetchall(
+                "select state from ayaka_box_state where box_name=? and group_id=?", key)
+            state = rows[0][0] if rows else "idle"
+            self.states[key] = state
+        return state
+
+    def set_state(self, box_name: str, group_id: int, state: str):
+        if self.get_state(box_name, group_id) == state:
+            return
+        self.states[(box_name, group_id)] = state
+        self._execute(
+            "replace into ayaka_box_state values (?,?,?)", (box_name, group_id, state))
+
+    def get_listeners(self, user_id: int):
+        # 监听可能由其他进程修改，因此每次读取
+        rows = self._fetchall(
+            "select group_id from ayaka_listener where user_id=? and (expire=0 or expire>?)", (user_id, time()))
+        return [row[0] for row in rows]
+
+    def add_listener(self, user_id: int, group_id: int, expire: float = 0):
+        self._execute(
+            "delete from ayaka_listener where expire>0 and expire<=?", (time(),))
+        self._execute(
+            "replace into ayaka_listener values (?,?,?)", (user_id, group_id, expire))
+
+    def remove_listener(self, user_id: int, group_id: int):
+        self._execute(
+            "delete from ayaka_listener where user_id=? and group_id=?", (user_id, group_id))
+
+    def remove_listeners(self, group_id: int):
+        self._execute(
+            "delete from ayaka_listener where group_id=?", (group_id,))
+
+
+def create_backend() -> AyakaStateBackend:
+    '''根据nonebot的配置创建状态后端'''
+    config = get_driver().config
+    name = getattr(config, "ayaka_state_backend", "memory")
+    worker_index = int(getattr(config, "ayaka_worker_index", 0))
+    worker_count = int(getattr(config, "ayaka_worker_count", 1))
+
+    if name == "memory":
+        if worker_count > 1:
+            logger.warning("多个ayaka进程共同运行时，建议使用sqlite状态后端，否则私聊监听无法在进程之间同步")
+        return AyakaMemoryBackend(worker_index, worker_count)
+    if name == "sqlite":
+        logger.opt(colors=True).info(
+            f"ayaka使用sqlite状态后端，当前进程 <y>{worker_index}</y>/<y>{worker_count}</y>")
+        return AyakaSqliteBackend(str(data_path / "state.db"), worker_index, worker_count)
+    raise Exception(f"不存在状态后端 {name}，可选 memory、sqlite")
+
+
+state_backend = create_backend()
+'''ayaka状态后端'''
@@ -0,0 +1,86 @@
+'''盒子屏蔽列表
+
+内存中使用集合判断是否屏蔽，屏蔽设置逐行保存在数据库中，每次修改只写入一行
+'''
+from .config import ayaka_root_config
+from .orm import AyakaDB, commit
+from .lazy import Field, logger
+
+
+class BlockBoxDB(AyakaDB):
+    '''盒子在群聊中的屏蔽设置，存在即屏蔽'''
+    __table_name__ = "ayaka_block_box"
+    box_name: str = Field(extra=AyakaDB.__primary_key__)
+    group_id: int = Field(extra=AyakaDB.__primary_key__)
+
+
+class AyakaBlockList:
+    '''盒子屏蔽列表'''
+
+    def __init__(self) -> None:
+        self.data: dict[str, set[int]] = {}
+        '''盒子名 → 屏蔽了该盒子的群聊'''
+
+    def get(self, box_name: str):
+        '''获取屏蔽了指定盒子的群聊集合，返回的集合在之后的修改中保持同一对象'''
+        return self.data.setdefault(box_name, set())
+
+    def is_blocked(self, box_name: str, group_id: int):
+        '''盒子是否在群聊中被屏蔽'''
+        return group_id in self.get(box_name)
+
+    def block(self, box_name: str, group_id: int):
+        '''在群聊中屏蔽盒子'''
+        group_ids = self.get(box_name)
+        if group_id in group_ids:
+            return
+        group_ids.add(group_id)
+        BlockBoxDB.replace(BlockBoxDB(box_name=box_name, group_id=group_id))
+
+    def unblock(self, box_name: str, group_id: int):
+        '''在群聊中取消屏蔽盒子'''
+        group_ids = self.get(box_name)
+        if group_id not in group_ids:
+            return
+        group_ids.discard(group_id)
+        BlockBoxDB.delete(box_name=box_name, group_id=group_id)
+
+    def load(self):
+        '''从数据库加载屏蔽设置，并迁移旧版保存在root.json中的设置
+
+        迁移的数据提交成功后才清除旧版设置，避免迁移中途失败导致设置丢失'''
+        old = ayaka_root_config.block_box_dict
+        if old:
+            self.migrate(old)
+
+        for data in BlockBoxDB.select_many():
+            self.get(data.box_name).add(data.group_id)
+
+        # 迁移失败时，保留的旧版设置依然生效
+        for box_name, group_ids in ayaka_root_config.block_box_dict.items():
+            self.get(box_name).update(group_ids)
+
+    def migrate(self, old: dict[str, list[int]]):
+        '''将旧版设置写入数据库，立即提交，成功后清除旧版设置'''
+        datas = [
+            BlockBoxDB(box_name=box_name, group_id=group_id)
+            for box_name, group_ids in old.items()
+            for group_id in set(group_ids)
+        ]
+        try:
+            if datas:
+                BlockBoxDB.replace_many(datas)
+        except Exception as e:
+            logger.opt(exception=e, colors=True).error(
+                "迁移盒子屏蔽设置失败，将在下次启动时重试")
+            return
+        if not commit():
+            logger.opt(colors=True).error("迁移盒子屏蔽设置失败，将在下次启动时重试")
+            return
+        ayaka_root_config.block_box_dict = {}
+        logger.opt(colors=True).info(
+            f"已迁移 <c>{len(datas)}</c> 条盒子屏蔽设置到数据库")
+
+
+block_list = AyakaBlockList()
+'''盒子屏蔽列表'''
@@ -3,16 +3,24 @@ ayaka 盒子
 
 ayaka的核心模块
 '''
+import inspect
 from math import ceil
+from time import perf_counter
 from typing import Callable, TypeVar
-from typing_extensions import Self
-from nonebot.rule import CommandRule
-from nonebot.matcher import Matcher, current_bot, current_event, current_matcher
-from nonebot.params import _command_arg, _raw_command
-
-from .helpers import Timer, _command_args, ensure_list, pack_messages, run_in_startup, is_async_callable
-from .lazy import Rule, GroupMessageEvent, PrivateMessageEvent, MessageEvent, Message, MessageSegment, Bot, BaseModel, get_driver, on_command, on_message, logger
-from .config import ayaka_root_config
+from nonebot.matcher import current_bot, current_event, current_handler, current_matcher
+
+from .helpers import ensure_list, pack_messages, run_in_startup
+from .lazy import Rule, GroupMessageEvent, MessageEvent, Message, MessageSegment, Bot, BaseModel, get_driver, on_command, on_message, logger
+from .config import ayaka_root_config, data_path
+from .dispatch import AyakaDispatcher
+from .registry import box_registry
+from .block import block_list
+from .backend import state_backend
+from .listener import ayaka_listener
+from .members import ayaka_members
+from .context import get_context
+from .profiler import ayaka_profiler
+from .sender import SEND_BUFFER_KEY, flush_send_buffer, send_group_msg, send_group_forward_msg
 
 
 driver = get_driver()
@@ -21,24 +29,21 @@ T = TypeVar("T")
 '''任意类型'''
 T_BaseModel = TypeVar("T_BaseModel", bound=BaseModel)
 '''BaseModel的子类'''
-group_dict: dict[int, "AyakaBox"] = {}
-'''群组字典'''
-box_list: list["AyakaBox"] = []
-'''box列表'''
-listeners: dict[int, list[int]] = {}
-'''监听列表，将私聊消息转发给当前正监听它的若干个群聊'''
-LISTEN = on_message(block=False)
-'''处理监听转发的matcher'''
 
 
 class AyakaMatcherCreaterUnit:
     '''matcher 创建器单元'''
 
-    def __init__(self, module_name: str, func: Callable, cmds: list[str], params: dict) -> None:
+    def __init__(self, module_name: str, func: Callable, cmds: list[str], params: dict, box: "AyakaBox" = None, states: list[str] = [], always: bool = False, extra_params: dict = {}) -> None:
         self.module_name = module_name
         self.func = func
         self.cmds = cmds
         self.params = params
+        self.box = box
+        self.states = states
+        self.always = always
+        self.extra_params = extra_params
+        '''未合并盒子状态规则的参数，供分发器使用'''
 
     def create(self):
         '''创建matcher'''
@@ -48,15 +53,21 @@ class AyakaMatcherCreaterUnit:
                 aliases=set(self.cmds[1:]),
                 **self.params
             )
+            matcher._ayaka_is_cmd = True
             matcher.module_name = self.module_name
             matcher.handle()(self.func)
         else:
             matcher = on_message(
                 **self.params
             )
+            matcher._ayaka_is_cmd = False
             matcher.module_name = self.module_name
             matcher.handle()(self.func)
 
+    def dispatch(self, dispatcher: AyakaDispatcher):
+        '''添加到分发器的路由表'''
+        dispatcher.add(self.box, self.func, self.cmds, self.states, self.always, self.extra_params)
+
 
 class AyakaMatcherCreater:
     '''matcher 创建器'''
@@ -64,6 +75,10 @@ class AyakaMatcherCreater:
     def __init__(self) -> None:
         self.has_created = False
         self.units: list[AyakaMatcherCreaterUnit] = []
+        self.dispatcher: AyakaDispatcher | None = None
+        '''单一分发器，仅在启用use_dispatcher时存在'''
+        self.root_priorities: set[int] = set()
+        '''已创建根matcher的优先级'''
 
     def warning_hint(self):
         info = "在 <y>ayaka</y> 创建matcher期间，可能会收到Duplicated prefix rule警告，而这是正常的"
@@ -73,29 +88,80 @@ class AyakaMatcherCreater:
         info = "<y>ayaka</y> 正在创建matcher ..."
         logger.opt(colors=True).warning(info)
 
-    def add(self, module_name: str, func: Callable, cmds: list[str], params: dict):
+    def add(self, module_name: str, func: Callable, cmds: list[str], params: dict, box: "AyakaBox" = None, states: list[str] = [], always: bool = False, extra_params: dict = {}):
         if not module_name:
             module_name = func.__module__
 
-        unit = AyakaMatcherCreaterUnit(module_name, func, cmds, params)
+        unit = AyakaMatcherCreaterUnit(
+            module_name, func, cmds, params, box, states, always, extra_params)
         self.units.append(unit)
 
         if self.has_created:
-            self.create_hint()
-            unit.create()
+            if self.dispatcher and unit.box:
+                unit.dispatch(self.dispatcher)
+                self.create_root_matcher(unit.extra_params.get("priority", 1))
+            else:
+                self.create_hint()
+                unit.create()
+
+    def create_root_matcher(self, priority: int):
+        '''为该优先级创建根matcher，已存在时跳过'''
+        if priority in self.root_priorities:
+            return
+        self.root_priorities.add(priority)
+        matcher = on_message(
+            rule=self.dispatcher.get_checker(priority),
+            priority=priority,
+            block=False
+        )
+        matcher.handle()(self.dispatcher.handle)
+
+    def create_dispatcher(self):
+        '''创建单一分发器，并为每个优先级创建根matcher，不属于任何盒子的单元仍然单独创建matcher'''
+        self.dispatcher = AyakaDispatcher(get_current_box)
+        units = [unit for unit in self.units if unit.box]
+        for unit in units:
+            unit.dispatch(self.dispatcher)
+
+        for priority in sorted({unit.extra_params.get("priority", 1) for unit in units}):
+            self.create_root_matcher(priority)
+
+        for unit in self.units:
+            if not unit.box:
+                unit.create()
 
     async def create_all(self):
-        self.warning_hint()
-        self.create_hint()
-        t = Timer(show=False)
-        with t:
+        if ayaka_root_config.use_dispatcher:
+            info = "<y>ayaka</y> 正在创建单一分发器 ..."
+            logger.opt(colors=True).warning(info)
+            with ayaka_profiler.measure("matcher", "<dispatcher>"):
+                self.create_dispatcher()
+        else:
+            self.warning_hint()
+            self.create_hint()
             for unit in self.units:
-                unit.create()
+                with ayaka_profiler.measure("matcher", unit.module_name):
+                    unit.create()
         self.has_created = True
 
+        # 所有插件此时均已导入，现在注册的启动钩子排在最后，在其他插件的启动钩子之后运行
+        run_in_startup(finish_startup)
+
+
+async def finish_startup():
+    '''标记启动完成，并写入启动耗时统计'''
+    if ayaka_profiler.ready is not None:
+        return
+    ayaka_profiler.mark_ready()
+    ayaka_profiler.dump(data_path / "startup_profile.json")
+    logger.opt(colors=True).info(
+        f"<y>ayaka</y> 启动完成，耗时 <y>{ayaka_profiler.ready:.2f}</y>s，详见 startup_profile.json")
+
 
 matcher_creator = AyakaMatcherCreater()
 run_in_startup(matcher_creator.create_all)
+# 驱动器不支持在启动期间注册启动钩子时，退而在bot首次连接时标记
+driver.on_bot_connect(finish_startup)
 
 
 def get_box(name: str):
@@ -110,44 +176,18 @@ def get_box(name: str):
         box 或 None
     '''
 
-    for box in box_list:
-        if box.name == name:
-            return box
-
-
-def cached(func):
-    '''在matcher.state中缓存内容
-
-    注意：如果和property装饰器配合使用，cached必须位于property装饰器下方'''
-    if is_async_callable(func):
-        async def _func(*args, **kwargs):
-            matcher_state = current_matcher.get().state
-            matcher_state.setdefault("ayaka", {})
-            data = matcher_state["ayaka"]
+    return box_registry.get(name)
 
-            key = func.__name__
-            if key not in data:
-                data[key] = await func(*args, **kwargs)
-            return data[key]
-    else:
-        def _func(*args, **kwargs):
-            matcher_state = current_matcher.get().state
-            matcher_state.setdefault("ayaka", {})
-            data = matcher_state["ayaka"]
 
-            key = func.__name__
-            if key not in data:
-                data[key] = func(*args, **kwargs)
-            return data[key]
-
-    return _func
+def get_current_box(group_id: int) -> "AyakaBox | None":
+    '''获取群聊的当前盒子'''
+    return box_registry.get(state_backend.get_current_box(group_id))
 
 
 @run_in_startup
 async def load_invalid_list():
     '''加载所有盒子的屏蔽配置'''
-    for b in box_list:
-        b._invalid_list = ayaka_root_config.block_box_dict.get(b.name, [])
+    block_list.load()
 
 
 class AyakaBox:
@@ -191,7 +231,7 @@ class AyakaBox:
             return b
         return super().__new__(cls)
 
-    def __init__(self, name: str, allow_same: bool = False, priority: int = 5) -> None:
+    def __init__(self, name: str, allow_same: bool = False, priority: int = 5, buffer_send: bool = False) -> None:
         '''初始化box对象
 
         参数:
@@ -204,6 +244,8 @@ class AyakaBox:
 
             priority: 注册命令的优先级；注册消息的优先级为priority+1
 
+            buffer_send: 启用发送缓冲，同一事件中多次box.send的消息将在回调结束后合并发送
+
         异常:
 
             已有重名box
@@ -213,14 +255,24 @@ class AyakaBox:
                 raise Exception(f"已有重名box: {name}")
             return
 
+        start = perf_counter()
+        frame = inspect.currentframe().f_back
         self.name = name
+        self.module_name: str = frame.f_globals.get("__name__", "")
+        '''创建该box的模块名'''
         self.priority = priority
+        self.buffer_send = buffer_send
+        '''是否启用发送缓冲'''
+        self._buffered_funcs: set[Callable] = set()
+        '''单独启用发送缓冲的回调'''
         self._intro = ""
         self._helps: dict[str, list] = {}
-        self._state_dict: dict[int, str] = {}
-        self._cache_dict: dict[int, dict] = {}
-        self._invalid_list: list[int] = []
-        box_list.append(self)
+        self._help_text: str | None = None
+        '''编译好的帮助，添加帮助时失效'''
+        self._cache_store = state_backend.create_cache(name)
+        self._invalid_set = block_list.get(name)
+        box_registry.add(self)
+        ayaka_profiler.record("box", name, perf_counter() - start)
         logger.opt(colors=True).debug(f"已生成盒子 <c>{name}</c>")
 
     # ---- 便捷属性 ----
@@ -266,49 +318,49 @@ class AyakaBox:
     @property
     def valid(self):
         '''当前盒子是否可用'''
-        return self.group_id not in self._invalid_list
+        return self.group_id not in self._invalid_set
 
     @valid.setter
     def valid(self, value: bool):
         '''设置当前盒子是否可用'''
-        change_flag = False
-        if value and not self.valid:
-            self._invalid_list.remove(self.group_id)
-            change_flag = True
-
-        elif not value and self.valid:
-            self._invalid_list.append(self.group_id)
-            change_flag = True
-
-        if change_flag:
-            ayaka_root_config.block_box_dict[self.name] = self._invalid_list
-            ayaka_root_config.save()
+        if value:
+            block_list.unblock(self.name, self.group_id)
+        else:
+            block_list.block(self.name, self.group_id)
 
     @property
     def current_box(self):
         '''当前运行盒子'''
-        return group_dict.get(self.group_id)
+        return get_current_box(self.group_id)
 
     @current_box.setter
-    def current_box(self, value: "Self"):
+    def current_box(self, value: "AyakaBox | None"):
         '''设置当前运行盒子'''
-        group_dict[self.group_id] = value
+        state_backend.set_current_box(
+            self.group_id, value.name if value else "")
 
     @property
     def state(self):
         '''盒子状态'''
-        return self._state_dict.get(self.group_id, "idle")
+        return self._get_state(self.group_id)
 
     @state.setter
     def state(self, value: str):
         '''设置盒子状态'''
-        self._state_dict[self.group_id] = value
+        state_backend.set_state(self.name, self.group_id, value)
+
+    def _get_state(self, group_id: int):
+        return state_backend.get_state(self.name, group_id)
 
     @property
     def cache(self):
         '''当前数据缓存'''
-        self._cache_dict.setdefault(self.group_id, {})
-        return self._cache_dict[self.group_id]
+        return self._cache_store.get(self.group_id)
+
+    @property
+    def cache_store(self):
+        '''所有群聊的数据缓存，可修改其max_groups、max_bytes、ttl、spill属性调整该盒子的缓存上限'''
+        return self._cache_store
 
     @property
     def bot_id(self):
@@ -331,32 +383,41 @@ class AyakaBox:
         return self.event.sender.card or self.event.sender.nickname
 
     @property
-    @cached
+    def context(self):
+        '''当前事件上下文，命令解析结果等在每个事件中只计算一次'''
+        return get_context()
+
+    @property
     def cmd(self):
         '''当前命令'''
-        if check_cmd_matcher(self.matcher):
-            return str(_raw_command(self.matcher_state))
-        else:
-            return ""
+        return get_context().cmd
 
     @property
-    @cached
     def arg(self):
         '''去除了命令之后的消息'''
-        if self.cmd:
-            return _command_arg(self.matcher_state)
-        else:
-            return self.message
+        return get_context().arg
 
     @property
-    @cached
     def args(self):
-        '''去除了命令之后的消息，再根据分割符进行分割'''
-        return _command_args(self.arg)
+        '''去除了命令之后的消息，再根据分割符进行分割，引号内的文本视为一个参数
+
+        返回AyakaArgs，可通过get_int、get_float、get_user_id、get_rest等方法按类型读取参数'''
+        return get_context().args
 
     @property
     def help(self):
-        '''box的帮助'''
+        '''box的帮助，只在添加帮助后的首次访问时生成'''
+        if self._help_text is None:
+            self._help_text = self._compile_help()
+        return self._help_text
+
+    @help.setter
+    def help(self, value: str):
+        '''设置box的帮助'''
+        self._intro = value.strip()
+        self._help_text = None
+
+    def _compile_help(self):
         items = [f"[{self.name}]"]
         if self._intro:
             items.append(self._intro)
@@ -370,11 +431,6 @@ class AyakaBox:
 
         return "\n".join(items)
 
-    @help.setter
-    def help(self, value: str):
-        '''设置box的帮助'''
-        self._intro = value.strip()
-
     # ---- 添加帮助 ----
     def _add_help(self, cmds: list[str], states: list[str], func=None):
         '''添加帮助
@@ -392,8 +448,8 @@ class AyakaBox:
             info += "/".join(cmds) + " "
         else:
             info += "<任意文字> "
-        if func and func.__doc__:
-            info += func.__doc__
+        doc = func.__doc__ if func and func.__doc__ else ""
+        info += doc
         if not states:
             states = ["群聊闲置状态"]
         for state in states:
@@ -401,6 +457,8 @@ class AyakaBox:
                 self._helps[state] = [info]
             else:
                 self._helps[state].append(info)
+        box_registry.add_help(self, states, cmds, info, doc)
+        self._help_text = None
 
     # ---- 设置状态 ----
     def set_state(self, state: str):
@@ -487,7 +545,11 @@ class AyakaBox:
         def ayaka_state_checker(event: GroupMessageEvent):
             # 盒子是否被屏蔽
             group_id = event.group_id
-            if group_id in self._invalid_list:
+            if group_id in self._invalid_set:
+                return False
+
+            # 群聊是否由当前进程处理
+            if not state_backend.owns(group_id):
                 return False
 
             # 盒子是否不受ayaka状态约束
@@ -495,7 +557,7 @@ class AyakaBox:
                 return True
 
             # 群聊闲置状态时响应
-            current_box = group_dict.get(group_id)
+            current_box = get_current_box(group_id)
             if not states:
                 return not current_box
 
@@ -508,13 +570,13 @@ class AyakaBox:
                 return True
 
             # 当前盒子状态是否符合要求
-            box_state = self._state_dict.get(group_id, "idle")
+            box_state = self._get_state(group_id)
             return box_state in states
 
         return Rule(ayaka_state_checker)
 
     # ---- on_xxx ----
-    def _on(self, cmds: str | list[str] = [], states: str | list[str] = [], always: bool = False, module_name: str = "", **params):
+    def _on(self, cmds: str | list[str] = [], states: str | list[str] = [], always: bool = False, module_name: str = "", buffer_send: bool = False, **params):
         '''注册命令处理回调（基础）
 
         参数:
@@ -527,6 +589,8 @@ class AyakaBox:
 
             module_name: 生成的matcher的module_name
 
+            buffer_send: 为该回调单独启用发送缓冲
+
             params: 其他参数，参考nonebot.on_command
 
         返回:
@@ -542,13 +606,21 @@ class AyakaBox:
         if "" in states:
             raise Exception("state不可为空字符串")
 
+        extra_params = params.copy()
         rule = params.get("rule", None)
         rule = self.rule(states=states, always=always) & rule
         params["rule"] = rule
 
         def decorator(func):
+            if buffer_send:
+                self._buffered_funcs.add(func)
             self._add_help(cmds, states, func)
-            matcher_creator.add(module_name, func, cmds, params)
+            if cmds:
+                box_registry.add_command(self, cmds, states, always)
+            matcher_creator.add(
+                module_name, func, cmds, params,
+                self, states, always, extra_params
+            )
             return func
         return decorator
 
@@ -673,7 +745,7 @@ class AyakaBox:
             key = key_or_obj.__class__.__name__
         else:
             raise Exception("参数类型错误，必须是字符串或BaseModel对象")
-        self.cache.pop(key, None)
+        self._cache_store.discard(self.group_id, key)
 
     def get_arbitrary_data(self, key: str, default_factory: Callable[[], T]) -> T:
         '''从当前群组的缓存中加载指定key下的任意类型对象，即self.cache[key]，若不存在则自动通过default_factory()创建
@@ -688,9 +760,15 @@ class AyakaBox:
 
             self.cache[key]
         '''
-        if key not in self.cache:
-            self.cache[key] = default_factory()
-        return self.cache[key]
+        cache = self.cache
+        if key not in cache:
+            data = default_factory()
+            # 被淘汰的BaseModel对象，以默认值的类型恢复
+            if isinstance(data, BaseModel):
+                data = self._cache_store.restore(
+                    self.group_id, key, data.__class__) or data
+            cache[key] = data
+        return cache[key]
 
     def get_data(self, cls: type[T_BaseModel], key: str = None) -> T_BaseModel:
         '''从当前群组的缓存中加载指定的BaseModel对象
@@ -724,19 +802,60 @@ class AyakaBox:
         '''
         if key is None:
             key = cls.__name__
-        if key not in self.cache:
-            data = cls()
-            self.cache[key] = data
+        cache = self.cache
+        if key not in cache:
+            data = self._cache_store.restore(self.group_id, key, cls) or cls()
+            cache[key] = data
             return data
-        return self.cache[key]
+        return cache[key]
 
     # ---- 快捷发送 ----
-    async def send(self, message: Message | MessageSegment | str):
-        '''发送消息'''
-        return await self.matcher.send(message)
+    async def send(self, message: Message | MessageSegment | str, wait: bool | None = None):
+        '''发送消息
+
+        发送队列与发送缓冲只对群聊消息事件生效，其他事件（例如私聊）直接通过matcher发送
+
+        参数:
+
+            message: 消息
+
+            wait: 启用发送队列时，是否等待发送完成，为None时使用根配置的send_wait；未启用时总是等待
+
+        返回:
+
+            API的结果，不等待发送完成或消息被放入发送缓冲时返回None
+        '''
+        if not isinstance(current_event.get(), GroupMessageEvent):
+            return await self.matcher.send(message)
+        buffer = self._get_send_buffer()
+        if buffer is not None:
+            buffer.append(message)
+            return
+        return await send_group_msg(self.bot, self.group_event, message, wait)
+
+    def _get_send_buffer(self) -> list | None:
+        '''获取当前事件的发送缓冲，未启用时返回None'''
+        if not self.buffer_send:
+            handler = current_handler.get(None)
+            if not handler or handler.call not in self._buffered_funcs:
+                return None
+        return self.matcher_state.setdefault(SEND_BUFFER_KEY, [])
+
+    async def flush(self):
+        '''立即发送当前事件中被缓冲的消息，回调结束时也会自动发送'''
+        event = current_event.get()
+        if isinstance(event, GroupMessageEvent):
+            await flush_send_buffer(self.bot, event, self.matcher_state)
+
+    async def send_many(self, messages: list[Message | MessageSegment | str], wait: bool | None = None):
+        '''发送合并转发消息
 
-    async def send_many(self, messages: list[Message | MessageSegment | str]):
-        '''发送合并转发消息'''
+        参数:
+
+            messages: 消息列表
+
+            wait: 同send
+        '''
         # 分割长消息组（不可超过100条
         div_len = 100
         div_cnt = ceil(len(messages) / div_len)
@@ -746,53 +865,36 @@ class AyakaBox:
                 user_name="Ayaka Bot",
                 messages=messages[i*div_len: (i+1)*div_len]
             )
-            await self.bot.send_group_forward_msg(group_id=self.group_id, messages=msgs)
+            await send_group_forward_msg(self.bot, self.group_id, msgs, wait)
 
     async def send_help(self):
         '''发送自身帮助'''
         await self.send(self.help)
 
-    # ---- 监听私聊 ----
-    def add_listener(self, user_id: int):
-        '''为该群组添加对指定私聊的监听'''
-        if user_id not in listeners:
-            listeners[user_id] = []
-        listeners[user_id].append(self.group_id)
-
-    def remove_listener(self, user_id: int = 0):
-        '''默认移除该群组对其他私聊的所有监听'''
-        if user_id == 0:
-            uids = list(listeners.keys())
-            for uid in uids:
-                self.remove_listener(uid)
-            return
-
-        if self.group_id in listeners[user_id]:
-            if len(listeners[user_id]) == 1:
-                listeners.pop(user_id)
-            else:
-                listeners[user_id].remove(self.group_id)
+    # ---- 群成员 ----
+    async def get_members(self):
+        '''获取当前群聊的成员索引，成员列表在根配置的member_cache_ttl内只获取一次'''
+        return await ayaka_members.get(self.bot, self.group_id)
 
+    async def get_user(self, m: MessageSegment | str):
+        '''根据MessageSegment，通过uid/uname/[CQ:at]/@xxx四种可能的查找方式，在当前群聊中查找对应user的信息，找不到时返回None'''
+        return await ayaka_members.get_user(self.bot, self.group_id, m)
 
-@LISTEN.handle()
-async def listener_handle(bot: Bot, event: PrivateMessageEvent):
-    if event.user_id in listeners:
-        _event = GroupMessageEvent(
-            **event.dict(exclude={"message_type"}),
-            group_id=0,
-            message_type="group"
-        )
+    # ---- 监听私聊 ----
+    def add_listener(self, user_id: int, ttl: float | None = None):
+        '''为该群组添加对指定私聊的监听
 
-        for group_id in listeners[event.user_id]:
-            _event.group_id = group_id
-            await bot.handle_event(_event)
+        参数:
 
+            user_id: 私聊的用户id
 
-def check_cmd_matcher(matcher: Matcher):
-    '''探测一个matcher是否由on_command创建的
+            ttl: 有效期（秒），为None时使用根配置的listener_ttl，为0时永不过期
+        '''
+        ayaka_listener.add(user_id, self.group_id, ttl)
 
-    这不是个好方法，但是我也没办法'''
-    for c in matcher.rule.checkers:
-        if isinstance(c.call, CommandRule):
-            return True
-    return False
+    def remove_listener(self, user_id: int = 0):
+        '''默认移除该群组对其他私聊的所有监听'''
+        if user_id == 0:
+            ayaka_listener.remove_all(self.group_id)
+        else:
+            ayaka_listener.remove(user_id, self.group_id)
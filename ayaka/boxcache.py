@@ -0,0 +1,234 @@
+'''盒子的群聊数据缓存
+
+每个盒子为每个群聊保存一个字典，即box.cache
+
+默认不淘汰；设置根配置的box_cache_*后，群聊长时间未访问，或群聊数量、估计占用超过上限时，按最近最少使用的顺序淘汰群聊的缓存
+
+淘汰时BaseModel对象会被转存到数据库，下次通过get_data等方法访问时恢复，其他类型的对象则被丢弃并发出警告；盒子正在运行的群聊不会被淘汰
+'''
+import sys
+from collections import OrderedDict
+from time import monotonic
+from typing import Callable, TypeVar
+from .config import ayaka_root_config
+from .orm import AyakaDB
+from .lazy import BaseModel, Field, logger
+
+T_BaseModel = TypeVar("T_BaseModel", bound=BaseModel)
+
+
+class BoxCacheDB(AyakaDB):
+    '''被淘汰的缓存对象'''
+    __table_name__ = "ayaka_box_cache"
+    box_name: str = Field(extra=AyakaDB.__primary_key__)
+    group_id: int = Field(extra=AyakaDB.__primary_key__)
+    key: str = Field(extra=AyakaDB.__primary_key__)
+    data: str = ""
+
+
+class AyakaGroupCache(dict):
+    '''群聊的缓存，在字典的基础上记录最近访问时间和被转存的对象'''
+    __slots__ = ("last_access", "spilled")
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.last_access = monotonic()
+        self.spilled: dict[str, str] = {}
+        '''键 → 被转存到数据库的对象的json'''
+
+
+def get_size(value) -> int:
+    '''估计对象占用的内存'''
+    if isinstance(value, BaseModel):
+        return len(value.json())
+    return sys.getsizeof(value)
+
+
+class AyakaBoxCache:
+    '''盒子的群聊数据缓存
+
+    参数:
+
+        box_name: 盒子名
+
+        is_running: 判断盒子是否正在群聊中运行，运行中的群聊不会被淘汰
+
+    属性:
+
+        max_groups: 最多缓存的群聊数量，为0时不限制
+
+        max_bytes: 所有群聊的缓存估计占用的上限，为0时不限制，在定期清理时检查
+
+        ttl: 群聊的缓存超过该时间（秒）未访问时淘汰，为0时永不过期
+
+        spill: 淘汰时是否转存BaseModel对象到数据库
+
+        sweep_interval: 定期清理的间隔（秒）
+    '''
+
+    def __init__(self, box_name: str, is_running: Callable[[int], bool] | None = None) -> None:
+        self.box_name = box_name
+        self.is_running = is_running
+        self.groups: OrderedDict[int, AyakaGroupCache] = OrderedDict()
+        self.max_groups = ayaka_root_config.box_cache_max_groups
+        self.max_bytes = ayaka_root_config.box_cache_max_bytes
+        self.ttl = ayaka_root_config.box_cache_ttl
+        self.spill = ayaka_root_config.box_cache_spill
+        self.sweep_interval = 60.0
+        self.last_sweep = monotonic()
+        self.size = 0
+        '''最近一次清理时估计的占用'''
+        self.spilled_groups: set[int] | None = None
+        '''在数据库中存有转存对象的群聊，首次使用时加载'''
+
+        self.evictions = 0
+        self.spilled_count = 0
+        self.dropped_count = 0
+        self.restored_count = 0
+
+    def __len__(self):
+        return len(self.groups)
+
+    def __contains__(self, group_id: int):
+        return group_id in self.groups
+
+    def get(self, group_id: int):
+        '''获取群聊的缓存，不存在则新建'''
+        group = self.groups.get(group_id)
+        if group is None:
+            group = self._load(group_id)
+            self.groups[group_id] = group
+        else:
+            self.groups.move_to_end(group_id)
+        group.last_access = monotonic()
+
+        if self.max_groups and len(self.groups) > self.max_groups:
+            self._evict_lru(group_id)
+        if group.last_access - self.last_sweep >= self.sweep_interval:
+            self.sweep(group_id)
+        return group
+
+    def restore(self, group_id: int, key: str, cls: type[T_BaseModel]) -> T_BaseModel | None:
+        '''若key对应的对象曾被转存，则以cls恢复它并放回缓存'''
+        group = self.get(group_id)
+        raw = group.spilled.pop(key, None)
+        if raw is None:
+            return None
+        data = cls.parse_raw(raw)
+        group[key] = data
+        BoxCacheDB.delete(box_name=self.box_name,
+                          group_id=group_id, key=key)
+        self.restored_count += 1
+        return data
+
+    def discard(self, group_id: int, key: str):
+        '''移除键，包括已被转存的对象'''
+        group = self.get(group_id)
+        group.pop(key, None)
+        if group.spilled.pop(key, None) is not None:
+            BoxCacheDB.delete(box_name=self.box_name,
+                              group_id=group_id, key=key)
+
+    def sweep(self, keep: int | None = None):
+        '''淘汰过期的群聊，并在估计占用超过上限时按最近最少使用的顺序淘汰
+
+        参数:
+
+            keep: 不淘汰该群聊，通常是当前正在访问的群聊
+        '''
+        now = monotonic()
+        self.last_sweep = now
+        if self.ttl:
+            expired = [
+                group_id for group_id, group in self.groups.items()
+                if group_id != keep and now - group.last_access >= self.ttl
+            ]
+            for group_id in expired:
+                self.evict(group_id)
+
+        if not self.max_bytes:
+            return
+        sizes = {
+            group_id: sum(get_size(v) for v in group.values())
+            for group_id, group in self.groups.items()
+        }
+        self.size = sum(sizes.values())
+        for group_id in list(self.groups):
+            if self.size <= self.max_bytes:
+                break
+            if group_id != keep and self.evict(group_id):
+                self.size -= sizes[group_id]
+
+    def _evict_lru(self, keep: int):
+        for group_id in list(self.groups):
+            if len(self.groups) <= self.max_groups:
+                break
+            if group_id != keep:
+                self.evict(group_id)
+
+    def evict(self, group_id: int):
+        '''淘汰群聊的缓存，盒子正在该群聊运行时不淘汰，返回是否已淘汰'''
+        if group_id not in self.groups:
+            return False
+        if self.is_running and self.is_running(group_id):
+            return False
+        group = self.groups.pop(group_id)
+        self.evictions += 1
+
+        datas = []
+        if self.spill:
+            datas = [
+                BoxCacheDB(
+                    box_name=self.box_name, group_id=group_id,
+                    key=key, data=value.json()
+                )
+                for key, value in group.items()
+                if isinstance(value, BaseModel)
+            ]
+        if datas:
+            BoxCacheDB.replace_many(datas)
+        # 之前转存且尚未恢复的对象仍在数据库中
+        if datas or group.spilled:
+            self._get_spilled_groups().add(group_id)
+        self.spilled_count += len(datas)
+        spilled_keys = {data.key for data in datas}
+        dropped = [key for key in group if key not in spilled_keys]
+        if dropped:
+            self.dropped_count += len(dropped)
+            logger.opt(colors=True).warning(
+                f"盒子 <c>{self.box_name}</c> 淘汰群聊 <y>{group_id}</y> 的缓存时，丢弃了无法转存的数据 <r>{', '.join(dropped)}</r>")
+        logger.opt(colors=True).debug(
+            f"盒子 <c>{self.box_name}</c> 淘汰了群聊 <y>{group_id}</y> 的缓存")
+        return True
+
+    def _get_spilled_groups(self):
+        if self.spilled_groups is None:
+            query = f"select distinct group_id from \"{BoxCacheDB.__table_name__}\" where box_name=?"
+            BoxCacheDB.create_table()
+            with BoxCacheDB.get_lock():
+                rows = BoxCacheDB.get_db().execute(
+                    query, (self.box_name,)).fetchall()
+            self.spilled_groups = {row[0] for row in rows}
+        return self.spilled_groups
+
+    def _load(self, group_id: int):
+        group = AyakaGroupCache()
+        spilled_groups = self._get_spilled_groups()
+        if group_id in spilled_groups:
+            spilled_groups.discard(group_id)
+            for data in BoxCacheDB.select_many(box_name=self.box_name, group_id=group_id):
+                group.spilled[data.key] = data.data
+        return group
+
+    def stats(self):
+        '''返回缓存的统计'''
+        return {
+            "groups": len(self.groups),
+            "entries": sum(len(group) for group in self.groups.values()),
+            "spilled_entries": sum(len(group.spilled) for group in self.groups.values()),
+            "size": self.size,
+            "evictions": self.evictions,
+            "spilled": self.spilled_count,
+            "dropped": self.dropped_count,
+            "restored": self.restored_count,
+        }
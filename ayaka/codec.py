@@ -0,0 +1,147 @@
+'''json列的编解码器
+
+AyakaDB的json列通过编解码器读写，可选用标准库json、orjson（已安装时），或在json基础上对大数据进行zlib压缩
+
+内置的编解码器在解码时都会识别zlib压缩的数据，因此可以互相读取，切换编解码器不需要迁移旧数据；自定义编解码器请在解码前调用unpack
+'''
+import json
+import zlib
+from abc import ABC, abstractmethod
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+MAGIC = b"AYKZ"
+'''zlib压缩数据的前缀'''
+
+
+def unpack(raw: str | bytes | memoryview):
+    '''若为zlib编解码器压缩的数据，则解压'''
+    if isinstance(raw, (bytes, memoryview)):
+        raw = bytes(raw)
+        if raw.startswith(MAGIC):
+            raw = zlib.decompress(raw[len(MAGIC):])
+    return raw
+
+
+class AyakaCodec(ABC):
+    '''json列的编解码器，继承时请实现encode和decode方法'''
+
+    @abstractmethod
+    def encode(self, value) -> str | bytes:
+        '''将值编码为写入数据库的数据'''
+        raise NotImplementedError
+
+    @abstractmethod
+    def decode(self, raw: str | bytes):
+        '''将数据库中的数据解码为值'''
+        raise NotImplementedError
+
+
+class JsonCodec(AyakaCodec):
+    '''标准库json
+
+    参数:
+
+        compact: 是否省略分隔符后的空格
+    '''
+
+    def __init__(self, compact: bool = False) -> None:
+        self.separators = (",", ":") if compact else None
+
+    def encode(self, value):
+        return json.dumps(
+            value, ensure_ascii=False,
+            separators=self.separators, default=pydantic_encoder
+        )
+
+    def decode(self, raw):
+        if raw is None:
+            return None
+        return json.loads(unpack(raw))
+
+
+class OrjsonCodec(AyakaCodec):
+    '''orjson，速度远快于标准库json，需要安装orjson'''
+
+    def __init__(self) -> None:
+        if not orjson:
+            raise Exception("未安装orjson")
+
+    def encode(self, value):
+        # 写入str而非bytes，与json编解码器写入的数据保持一致
+        return orjson.dumps(
+            value, default=pydantic_encoder,
+            option=orjson.OPT_NON_STR_KEYS
+        ).decode()
+
+    def decode(self, raw):
+        if raw is None:
+            return None
+        return orjson.loads(unpack(raw))
+
+
+class ZlibCodec(AyakaCodec):
+    '''紧凑的json，长度达到threshold时使用zlib压缩，以bytes形式写入
+
+    参数:
+
+        inner: 压缩前使用的编解码器
+
+        threshold: 编码后的长度达到该值时压缩
+
+        level: 压缩等级
+    '''
+    MAGIC = MAGIC
+    '''压缩数据的前缀'''
+
+    def __init__(self, inner: AyakaCodec | None = None, threshold: int = 1024, level: int = 6) -> None:
+        self.inner = inner or JsonCodec(compact=True)
+        self.threshold = threshold
+        self.level = level
+
+    def encode(self, value):
+        text = self.inner.encode(value)
+        if len(text) < self.threshold:
+            return text
+        return self.MAGIC + zlib.compress(text.encode(), self.level)
+
+    def decode(self, raw):
+        if raw is None:
+            return None
+        return self.inner.decode(unpack(raw))
+
+
+codecs: dict[str, AyakaCodec] = {
+    "json": JsonCodec(),
+    "zlib": ZlibCodec(JsonCodec(compact=True)),
+}
+'''名称 → 编解码器'''
+
+if orjson:
+    codecs["orjson"] = OrjsonCodec()
+    codecs["zlib"] = ZlibCodec(OrjsonCodec())
+
+
+def register_codec(name: str, codec: AyakaCodec):
+    '''注册编解码器，之后可以在__json_codec__或根配置的db_json_codec中使用该名称'''
+    codecs[name] = codec
+
+
+def get_codec(name: str):
+    '''获取编解码器，auto表示已安装orjson时使用orjson，否则使用json
+
+    异常:
+
+        编解码器不存在
+    '''
+    if name == "auto":
+        name = "orjson" if "orjson" in codecs else "json"
+    codec = codecs.get(name)
+    if not codec:
+        raise Exception(f"不存在编解码器 {name}")
+    return codec
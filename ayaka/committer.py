@@ -0,0 +1,170 @@
+'''数据库组提交
+
+写入后不立即提交，而是在待提交的写入数达到上限，或最早一次未提交的写入等待超过最大延迟时，统一提交一次，并定期执行WAL检查点
+'''
+import asyncio
+import sqlite3
+import threading
+from time import monotonic
+from typing import Awaitable, Callable
+from .lazy import BaseModel, logger
+
+
+class AyakaCommitStats(BaseModel):
+    '''提交统计'''
+    commits: int = 0
+    '''提交次数'''
+    writes: int = 0
+    '''已提交的写入数'''
+    max_batch: int = 0
+    '''单次提交包含的最大写入数'''
+    pending: int = 0
+    '''当前尚未提交的写入数'''
+    last_latency: float = 0
+    '''最近一次提交时，最早一次写入已等待的时间（秒）'''
+    max_latency: float = 0
+    '''写入等待提交的最长时间（秒）'''
+    commit_seconds: float = 0
+    '''提交耗费的总时间（秒）'''
+    checkpoints: int = 0
+    '''检查点次数'''
+    wal_frames: int = 0
+    '''最近一次检查点时WAL文件中的页数'''
+    failures: int = 0
+    '''提交失败次数'''
+
+
+class AyakaDBCommitter:
+    '''组提交调度器
+
+    参数:
+
+        db: 写连接
+
+        lock: 保护写连接的锁
+
+        max_latency: 写入等待提交的最长时间（秒）
+
+        max_pending: 待提交的写入数达到该值时立即提交
+
+        checkpoint_interval: WAL检查点间隔（秒）
+    '''
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.RLock, max_latency: float = 1, max_pending: int = 1000, checkpoint_interval: float = 300) -> None:
+        self.db = db
+        self.lock = lock
+        self.max_latency = max_latency
+        self.max_pending = max_pending
+        self.checkpoint_interval = checkpoint_interval
+        self.stats = AyakaCommitStats()
+        self.pending = 0
+        self.first_time = 0.0
+        '''最早一次未提交写入的时间，为0时没有已知的未提交写入'''
+        self.last_checkpoint = monotonic()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.event: asyncio.Event | None = None
+
+    def note_write(self, n: int = 1):
+        '''登记写入，须在持有锁时调用，可以在任意线程中调用'''
+        if n <= 0:
+            return
+        if not self.first_time:
+            self.first_time = monotonic()
+        self.pending += n
+        if self.pending >= self.max_pending:
+            self.wake()
+
+    def wake(self):
+        '''唤醒调度循环'''
+        if self.loop and self.event:
+            self.loop.call_soon_threadsafe(self.event.set)
+
+    def commit(self):
+        '''立即提交，可以在任意线程中调用
+
+        返回:
+
+            是否提交成功，没有需要提交的写入时同样返回True
+        '''
+        with self.lock:
+            if not self.db.in_transaction:
+                self.pending = 0
+                self.first_time = 0.0
+                return True
+
+            start = monotonic()
+            latency = start - self.first_time if self.first_time else 0
+            try:
+                self.db.commit()
+            except sqlite3.Error as e:
+                self.stats.failures += 1
+                logger.opt(colors=True).error(f"提交数据库失败 <r>{e}</r>")
+                return False
+
+            stats = self.stats
+            stats.commits += 1
+            stats.writes += self.pending
+            stats.max_batch = max(stats.max_batch, self.pending)
+            stats.last_latency = latency
+            stats.max_latency = max(stats.max_latency, latency)
+            stats.commit_seconds += monotonic() - start
+            self.pending = 0
+            self.first_time = 0.0
+        logger.debug("更新数据库")
+        return True
+
+    def checkpoint(self, mode: str = "PASSIVE"):
+        '''执行WAL检查点，将WAL文件中的修改写回数据库文件'''
+        with self.lock:
+            busy, frames, _ = self.db.execute(
+                f"PRAGMA wal_checkpoint({mode})").fetchone()
+        self.last_checkpoint = monotonic()
+        self.stats.checkpoints += 1
+        self.stats.wal_frames = frames
+        if busy:
+            logger.debug("WAL检查点未能完成，存在正在进行的读操作")
+
+    def get_stats(self):
+        '''返回提交统计'''
+        self.stats.pending = self.pending
+        return self.stats.copy()
+
+    def due(self):
+        '''是否应当提交'''
+        if not self.first_time:
+            # 通过get_db直接执行的写入不会登记，因此以未结束的事务为准
+            if not self.db.in_transaction:
+                return False
+            self.first_time = monotonic()
+        return self.pending >= self.max_pending or monotonic() - self.first_time >= self.max_latency
+
+    async def run(self, run_in_writer: Callable[[Callable], Awaitable], before_commit: Callable[[], Awaitable]):
+        '''调度循环
+
+        参数:
+
+            run_in_writer: 在写线程中执行函数
+
+            before_commit: 每次唤醒时执行，用于写入被标记为脏的对象
+        '''
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+        while True:
+            timeout = self.max_latency
+            if self.first_time:
+                timeout = max(self.first_time + self.max_latency - monotonic(), 0)
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.event.clear()
+
+            try:
+                await before_commit()
+                if self.due():
+                    await run_in_writer(self.commit)
+                if monotonic() - self.last_checkpoint >= self.checkpoint_interval:
+                    await run_in_writer(self.checkpoint)
+            except Exception as e:
+                logger.exception(e)
@@ -1,10 +1,18 @@
 '''
     管理插件配置，提供读写支持
 '''
+import asyncio
+import itertools
 import json
+import os
+import tempfile
+import threading
+from time import perf_counter
 from pydantic import ValidationError
+from pydantic.main import ModelMetaclass
 from .helpers import ensure_dir_exists
-from .lazy import logger, BaseModel, Path
+from .lazy import logger, BaseModel, Path, get_driver
+from .profiler import ayaka_profiler
 
 AYAKA_VERSION = "1.0.3b1"
 logger.opt(colors=True).success(f"<y>ayaka</y> 当前版本 <y>{AYAKA_VERSION}</y>")
@@ -12,31 +20,142 @@ logger.opt(colors=True).success(f"<y>ayaka</y> 当前版本 <y>{AYAKA_VERSION}</
 data_path = Path("data", "ayaka")
 ensure_dir_exists(data_path)
 
+_config_instances: dict[str, "AyakaConfig"] = {}
+'''各配置共享的实例'''
+_config_stats: dict[str, tuple[int, int]] = {}
+'''各配置文件最近一次读写时的(mtime, size)'''
+_dirty_configs: dict[str, "AyakaConfig"] = {}
+'''等待延迟写入的配置'''
+_save_tasks: dict[str, asyncio.Task] = {}
+'''延迟写入任务'''
+_write_locks: dict[str, threading.Lock] = {}
+'''各配置文件的写入锁，延迟写入在工作线程中进行，可能与立即写入同时发生'''
+_snapshot_counter = itertools.count()
+'''配置快照的序号，在事件循环中生成快照时递增'''
+_written_snapshots: dict[str, int] = {}
+'''各配置文件最近一次写入的快照序号'''
 
-class AyakaConfig(BaseModel):
+
+def _dumps(data: dict):
+    return json.dumps(data, ensure_ascii=0, indent=4)
+
+
+def _get_stat(path: Path):
+    '''返回文件的(mtime, size)，文件不存在时返回None'''
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _snapshot(config: "AyakaConfig"):
+    '''在事件循环中生成配置的快照及其序号'''
+    return config.dict(), next(_snapshot_counter)
+
+
+def _write_file(path: Path, data: dict, snapshot: int):
+    '''先写入唯一的临时文件，再原子地替换目标文件，避免写入中途崩溃导致文件损坏
+
+    同一文件的写入依次进行，已写入更新的快照时跳过，返回写入后文件的(mtime, size)'''
+    key = str(path)
+    lock = _write_locks.setdefault(key, threading.Lock())
+    with lock:
+        if snapshot < _written_snapshots.get(key, -1):
+            return _get_stat(path)
+        with tempfile.NamedTemporaryFile(
+            "w", encoding="utf8", dir=path.parent,
+            prefix=f"{path.name}.", suffix=".tmp", delete=False
+        ) as f:
+            tmp_path = f.name
+            try:
+                f.write(_dumps(data))
+                f.flush()
+                os.fsync(f.fileno())
+            except BaseException:
+                f.close()
+                os.unlink(tmp_path)
+                raise
+        os.replace(tmp_path, path)
+        _written_snapshots[key] = snapshot
+        return _get_stat(path)
+
+
+async def _save_later(name: str, delay: float):
+    '''等待时间窗口结束后，在工作线程中写入配置'''
+    await asyncio.sleep(delay)
+    _save_tasks.pop(name, None)
+    config = _dirty_configs.pop(name, None)
+    if config:
+        # 在事件循环中生成快照，避免工作线程读取到修改中途的数据
+        data, snapshot = _snapshot(config)
+        _config_stats[name] = await asyncio.to_thread(_write_file, config._path, data, snapshot)
+        logger.opt(colors=True).debug(f"已延迟写入配置文件 <g>{name}</g>")
+
+
+@get_driver().on_shutdown
+async def flush_configs():
+    '''关闭前写入所有尚未写入的配置'''
+    for task in _save_tasks.values():
+        task.cancel()
+    _save_tasks.clear()
+    for config in list(_dirty_configs.values()):
+        config.flush()
+
+
+class AyakaConfigMeta(ModelMetaclass):
+    '''令同名配置在进程内共享同一个实例
+
+    只拦截直接调用类创建实例，pydantic的copy、construct、deepcopy等通过__new__创建的副本不受影响'''
+
+    def __call__(cls, *args, **kwargs):
+        config = _config_instances.get(cls.__config_name__)
+        if type(config) is cls:
+            # 文件发生变化时重新读取
+            config.__init__(*args, **kwargs)
+            return config
+        return super().__call__(*args, **kwargs)
+
+
+class AyakaConfig(BaseModel, metaclass=AyakaConfigMeta):
     '''继承时请填写`__config_name__`
 
     该配置保存在data/ayaka/<__config_name__>.json
 
     在修改不可变成员属性时，`AyakaConfig`会自动写入到本地文件，但修改可变成员属性时，需要手动执行save函数
+
+    设置`__save_delay__`或根配置的`config_save_delay`后，写入将延迟到时间窗口结束时，在工作线程中合并完成
+
+    同名配置在进程内共享同一个实例，仅当配置文件的修改时间或大小发生变化时才会重新读取
     '''
     __config_name__ = ""
     '''配置文件的名称'''
+    __save_delay__: float | None = None
+    '''延迟写入的时间窗口（秒），为None时使用根配置的config_save_delay，为0时立即写入'''
 
     def __init__(self):
         name = self.__config_name__
         if not name:
             raise Exception("__config_name__不可为空")
 
+        start = perf_counter()
+        path = data_path / f"{name}.json"
+        stat = _get_stat(path)
+
+        # 共享实例未过期，或尚有未写入的修改
+        if _config_instances.get(name) is self:
+            if stat == _config_stats.get(name) or name in _dirty_configs:
+                return
+
         # 默认空数据
         data = {}
+        text = ""
 
         try:
-            path = data_path / f"{name}.json"
             # 存在则读取
-            if path.exists():
-                with path.open("r", encoding="utf8") as f:
-                    data = json.load(f)
+            if stat:
+                text = path.read_text(encoding="utf8")
+                data = json.loads(text)
 
             # 载入数据
             super().__init__(**data)
@@ -46,8 +165,14 @@ class AyakaConfig(BaseModel):
                 f"导入配置失败，请检查{name}的配置是否正确；如果不确定出错的原因，可以尝试更新插件-删除配置-重启bot")
             raise e
 
-        # 强制更新（更新默认值）
-        self.save()
+        _config_instances[name] = self
+        _config_stats[name] = stat
+        # 写入耗时由save单独记录为config_save
+        ayaka_profiler.record("config_load", name, perf_counter() - start)
+
+        # 更新默认值，文件内容一致时无需写入
+        if _dumps(self.dict()) != text:
+            self.save()
         logger.opt(colors=True).debug(f"已载入配置文件 <g>{name}</g>")
 
     def __setattr__(self, name, value):
@@ -57,25 +182,139 @@ class AyakaConfig(BaseModel):
             logger.opt(colors=True).debug(
                 f"已自动写入配置更改 {self.__config_name__}.<c>{name}</c>")
 
+    @property
+    def _path(self):
+        return data_path / f"{self.__config_name__}.json"
+
+    def _get_save_delay(self):
+        delay = self.__save_delay__
+        if delay is None:
+            delay = ayaka_root_config.config_save_delay
+        return delay
+
     def save(self):
-        '''修改可变成员变量后，需要使用该方法才能保存其值到文件'''
+        '''修改可变成员变量后，需要使用该方法才能保存其值到文件
+
+        启用延迟写入时，该方法只将配置标记为待写入'''
+        delay = self._get_save_delay()
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            delay = 0
+
+        if delay <= 0:
+            self.flush()
+            return
+
         name = self.__config_name__
-        data = self.dict()
-        path = data_path / f"{name}.json"
-        with path.open("w+", encoding="utf8") as f:
-            json.dump(data, f, ensure_ascii=0, indent=4)
+        _dirty_configs[name] = self
+        if name not in _save_tasks:
+            _save_tasks[name] = asyncio.create_task(_save_later(name, delay))
+
+    def flush(self):
+        '''立即写入文件，并取消尚未执行的延迟写入'''
+        name = self.__config_name__
+        _dirty_configs.pop(name, None)
+        task = _save_tasks.pop(name, None)
+        if task:
+            task.cancel()
+        with ayaka_profiler.measure("config_save", name):
+            _config_stats[name] = _write_file(self._path, *_snapshot(self))
 
 
 class RootConfig(AyakaConfig):
     '''根配置'''
 
     __config_name__ = "root"
+    __save_delay__ = 0
 
     version: str = AYAKA_VERSION
     '''版本号'''
 
     block_box_dict: dict[str, list[int]] = {}
-    '''各个盒子被各群聊的屏蔽设置'''
+    '''[已过时] 各个盒子被各群聊的屏蔽设置，现已迁移到数据库，仅用于兼容旧版配置'''
+
+    config_save_delay: float = 0
+    '''各配置默认的延迟写入时间窗口（秒），为0时立即写入'''
+
+    db_reader_count: int = 4
+    '''数据库异步API使用的只读连接数量'''
+
+    db_commit_latency: float = 1
+    '''数据库写入等待提交的最长时间（秒）'''
+
+    db_commit_pending: int = 1000
+    '''待提交的写入数达到该值时立即提交'''
+
+    db_checkpoint_interval: float = 300
+    '''WAL检查点间隔（秒）'''
+
+    db_json_codec: str = "auto"
+    '''数据库json列默认使用的编解码器，可选json、orjson、zlib，auto表示已安装orjson时使用orjson'''
+
+    box_cache_max_groups: int = 0
+    '''每个盒子最多缓存的群聊数量，为0时不限制
+
+    注意：淘汰时只有BaseModel对象会被转存，其他类型的数据（例如通过get_arbitrary_data保存的dict、list）将被丢弃'''
+
+    box_cache_max_bytes: int = 0
+    '''每个盒子的群聊缓存估计占用的上限（字节），为0时不限制'''
+
+    box_cache_ttl: float = 0
+    '''群聊的缓存超过该时间（秒）未访问时淘汰，为0时永不过期'''
+
+    box_cache_spill: bool = True
+    '''淘汰群聊的缓存时，是否将其中的BaseModel对象转存到数据库，以便下次访问时恢复'''
+
+    listener_concurrency: int = 8
+    '''转发私聊消息给监听它的群聊时，同时处理的群聊数量上限'''
+
+    listener_ttl: float = 0
+    '''私聊监听默认的有效期（秒），为0时永不过期'''
+
+    send_queue: bool = False
+    '''启用消息发送队列，box.send等方法将消息放入群聊的队列，按速率限制依次发送'''
+
+    send_wait: bool = False
+    '''启用发送队列时，box.send等方法默认是否等待发送完成'''
+
+    send_group_rate: float = 1
+    '''每个群聊每秒最多发送的消息数，为0时不限制'''
+
+    send_group_burst: int = 5
+    '''每个群聊允许连续发送的消息数'''
+
+    send_bot_rate: float = 10
+    '''每个bot每秒最多发送的消息数，为0时不限制'''
+
+    send_bot_burst: int = 20
+    '''每个bot允许连续发送的消息数'''
+
+    send_buffer_threshold: int = 500
+    '''发送缓冲合并后的消息长度超过该值时，改为发送合并转发消息，为0时总是合并为一条消息'''
+
+    member_cache_ttl: float = 600
+    '''群成员列表的缓存时间（秒），过期后在下次查找时重新获取，为0时永不过期'''
+
+    member_cache_max_groups: int = 2000
+    '''最多缓存成员列表的群聊数量，为0时不限制'''
+
+    api_cache: dict[str, float] = {}
+    '''缓存结果的只读OneBot API → 缓存时间（秒），为0时永不过期，为空时不启用API缓存
+
+    例如 {"get_group_info": 300, "get_group_member_info": 60, "get_stranger_info": 300}'''
+
+    api_cache_max_size: int = 10000
+    '''每个API最多缓存的结果数，为0时不限制'''
+
+    api_cache_timeout: float = 30
+    '''并发调用相同API时，等待首个调用结果的最长时间（秒）'''
+
+    help_page_size: int = 10
+    '''全部盒子帮助每页展示的盒子数、搜索帮助每页展示的命令数，为0时不分页'''
+
+    use_dispatcher: bool = False
+    '''启用单一分发器，所有盒子的命令将按优先级通过同一个matcher分发，而非各自创建matcher'''
 
 
 ayaka_root_config = RootConfig()
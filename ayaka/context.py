@@ -0,0 +1,161 @@
+'''事件上下文
+
+每个事件的命令解析结果只计算一次，保存在matcher.state中，box.cmd、box.arg、box.args等属性直接读取其属性
+'''
+import asyncio
+from functools import wraps
+from typing import Any, Callable, TypeVar
+from nonebot.consts import PREFIX_KEY, RAW_CMD_KEY, CMD_ARG_KEY
+from nonebot.matcher import Matcher, current_event, current_matcher
+from nonebot.rule import CommandRule
+from .args import AyakaArgs, tokenize
+from .helpers import is_async_callable
+from .lazy import GroupMessageEvent, Message, MessageEvent
+
+T = TypeVar("T")
+
+CONTEXT_KEY = "ayaka_context"
+'''上下文保存在matcher.state中的键'''
+MEMO_KEY = "ayaka_memo"
+'''cached的缓存保存在matcher.state中的键'''
+
+
+class AyakaContext:
+    '''事件上下文
+
+    属性:
+
+        event: 当前消息事件
+
+        cmd: 当前命令，普通消息时为空字符串
+
+        arg: 去除了命令之后的消息
+
+        args: 去除了命令之后的消息，再根据分割符进行分割，首次访问时计算，同一事件中只解析一次
+
+        group_id: 群聊id，私聊时为None
+
+        user_id: 发送者id
+
+        user_name: 发送者群名片或qq昵称
+    '''
+    __slots__ = ("event", "cmd", "arg", "_args",
+                 "group_id", "user_id", "user_name")
+
+    def __init__(self, event: MessageEvent, cmd: str, arg: Message) -> None:
+        self.event = event
+        self.cmd = cmd
+        self.arg = arg
+        self._args: AyakaArgs | None = None
+        self.group_id: int | None = event.group_id if isinstance(
+            event, GroupMessageEvent) else None
+        self.user_id = event.user_id
+        self.user_name: str = event.sender.card or event.sender.nickname
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._args = tokenize(self.arg)
+        return self._args
+
+    @classmethod
+    def create(cls, event: MessageEvent, state: dict, is_cmd: bool):
+        '''根据nonebot的命令解析结果创建上下文'''
+        if is_cmd:
+            prefix = state[PREFIX_KEY]
+            return cls(event, str(prefix[RAW_CMD_KEY]), prefix[CMD_ARG_KEY])
+        return cls(event, "", event.message)
+
+
+def check_cmd_matcher(matcher: Matcher):
+    '''探测一个matcher是否由on_command创建的
+
+    这不是个好方法，但是我也没办法'''
+    for c in matcher.rule.checkers:
+        if isinstance(c.call, CommandRule):
+            return True
+    return False
+
+
+def is_cmd_matcher(matcher: Matcher) -> bool:
+    '''matcher是否由on_command创建的，ayaka创建matcher时已经标记，其他matcher在首次检查后标记'''
+    matcher_type = type(matcher)
+    flag = matcher_type.__dict__.get("_ayaka_is_cmd")
+    if flag is None:
+        flag = check_cmd_matcher(matcher)
+        matcher_type._ayaka_is_cmd = flag
+    return flag
+
+
+def set_context(event: MessageEvent, state: dict, is_cmd: bool):
+    '''创建并保存当前上下文'''
+    context = AyakaContext.create(event, state, is_cmd)
+    state[CONTEXT_KEY] = context
+    return context
+
+
+def get_context() -> AyakaContext:
+    '''获取当前上下文，不存在时创建
+
+    异常:
+
+        当前事件不是消息事件
+    '''
+    matcher = current_matcher.get()
+    context = matcher.state.get(CONTEXT_KEY)
+    if context is None:
+        event = current_event.get()
+        if not isinstance(event, MessageEvent):
+            raise Exception("只有收到消息事件时，才可访问该属性")
+        context = set_context(event, matcher.state, is_cmd_matcher(matcher))
+    return context
+
+
+def _make_key(func: Callable, args: tuple, kwargs: dict):
+    key = (func, args, tuple(sorted(kwargs.items())) if kwargs else ())
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def cached(func: Callable[..., T]) -> Callable[..., T]:
+    '''在当前事件中缓存函数的返回值，参数不同时分别缓存，参数不可哈希时不缓存
+
+    异步函数被并发调用时只执行一次，其他调用者等待同一个结果；执行失败时不缓存
+
+    注意：如果和property装饰器配合使用，cached必须位于property装饰器下方'''
+    if is_async_callable(func):
+        @wraps(func)
+        async def _func(*args, **kwargs):
+            key = _make_key(func, args, kwargs)
+            if key is None:
+                return await func(*args, **kwargs)
+
+            memo: dict[Any, asyncio.Future] = current_matcher.get().state.setdefault(MEMO_KEY, {})
+            future = memo.get(key)
+            if future is None:
+                future = asyncio.ensure_future(func(*args, **kwargs))
+                memo[key] = future
+
+                def discard_failed(future: asyncio.Future):
+                    if future.cancelled() or future.exception():
+                        memo.pop(key, None)
+                future.add_done_callback(discard_failed)
+
+            # 避免某个调用者被取消时，取消其他调用者共享的任务
+            return await asyncio.shield(future)
+    else:
+        @wraps(func)
+        def _func(*args, **kwargs):
+            key = _make_key(func, args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+
+            memo: dict = current_matcher.get().state.setdefault(MEMO_KEY, {})
+            if key not in memo:
+                memo[key] = func(*args, **kwargs)
+            return memo[key]
+
+    return _func
@@ -0,0 +1,272 @@
+'''单一分发器
+
+启用根配置的`use_dispatcher`后，ayaka为回调用到的每个优先级只注册一个根matcher，通过预编译的路由表
+
+    (当前盒子或闲置) → 状态 → 命令前缀树 → 回调
+
+分发群聊消息，单条消息的开销只与可能触发的回调有关，与已加载的盒子和命令数量无关
+
+根matcher的优先级与其中的回调相同，因此与其他插件的matcher之间仍然遵循nonebot的优先级与阻断规则
+
+注意：分发模式下仅支持rule、permission、priority、block参数，同一条消息触发的同一优先级的多个回调将在根matcher中依次运行
+'''
+from typing import TYPE_CHECKING, Any, Callable, Optional
+from nonebot.consts import PREFIX_KEY, CMD_KEY, RAW_CMD_KEY, CMD_ARG_KEY, CMD_START_KEY
+from nonebot.dependencies import Dependent
+from nonebot.matcher import Matcher
+from nonebot.permission import Permission
+
+from .lazy import Bot, GroupMessageEvent, Rule, T_State, get_driver
+from .backend import state_backend
+from .context import set_context
+
+if TYPE_CHECKING:
+    from .box import AyakaBox
+
+DISPATCH_KEY = "ayaka_dispatch"
+'''分发结果在matcher.state中的键名'''
+
+
+class CommandTrie:
+    '''命令前缀树，用于查找消息开头最长的已注册命令'''
+
+    def __init__(self) -> None:
+        self.root: dict = {}
+
+    def add(self, prefix: str, value: tuple[str, str]):
+        '''添加前缀，value为(命令起始符, 命令)'''
+        node = self.root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        # 字符均为str，因此使用None作为结束标记不会冲突
+        node[None] = value
+
+    def longest_prefix(self, text: str) -> Optional[tuple[int, tuple[str, str]]]:
+        '''返回(前缀长度, value)，若不存在则返回None'''
+        node = self.root
+        found = None
+        for i, c in enumerate(text):
+            node = node.get(c)
+            if node is None:
+                break
+            if None in node:
+                found = (i + 1, node[None])
+        return found
+
+
+class AyakaHandler:
+    '''路由表中的回调'''
+
+    __slots__ = ("box", "dependent", "is_cmd", "priority", "block", "rule", "permission", "order")
+
+    def __init__(self, box: "AyakaBox", func: Callable, is_cmd: bool, params: dict, order: int) -> None:
+        self.box = box
+        self.dependent = Dependent[Any].parse(
+            call=func, allow_types=Matcher.HANDLER_PARAM_TYPES
+        )
+        self.is_cmd = is_cmd
+        self.priority: int = params.get("priority", 1)
+        self.block: bool = params.get("block", True)
+        self.rule: Rule = Rule() & params.get("rule")
+        self.permission: Permission = Permission() | params.get("permission")
+        self.order = order
+
+    async def check(self, bot: Bot, event: GroupMessageEvent, state: T_State):
+        '''检查额外的rule和permission'''
+        return await self.permission(bot, event) and await self.rule(bot, event, state)
+
+
+class AyakaRoute:
+    '''路由表的一个节点'''
+
+    __slots__ = ("cmds", "texts")
+
+    def __init__(self) -> None:
+        self.cmds: dict[str, list[AyakaHandler]] = {}
+        '''命令 → 回调'''
+        self.texts: list[AyakaHandler] = []
+        '''消息回调'''
+
+    def add(self, handler: AyakaHandler, cmds: list[str]):
+        if cmds:
+            for cmd in cmds:
+                self.cmds.setdefault(cmd, []).append(handler)
+        else:
+            self.texts.append(handler)
+
+
+def _prepare_cmd(event: GroupMessageEvent, state: T_State):
+    '''令box.cmd、box.arg等属性返回当前命令的解析结果'''
+    state[PREFIX_KEY] = state[DISPATCH_KEY][0]
+    set_context(event, state, True)
+
+
+def _prepare_text(event: GroupMessageEvent, state: T_State):
+    '''令box.cmd、box.arg等属性视当前消息为普通消息'''
+    set_context(event, state, False)
+
+
+class AyakaDispatcher:
+    '''单一分发器'''
+
+    def __init__(self, get_current_box: Callable[[int], Optional["AyakaBox"]]) -> None:
+        self.get_current_box = get_current_box
+        self.trie = CommandTrie()
+        self.always = AyakaRoute()
+        '''always=True的回调'''
+        self.idle = AyakaRoute()
+        '''群聊闲置状态的回调'''
+        self.box_routes: dict[str, dict[str, AyakaRoute]] = {}
+        '''盒子名 → 状态 → 路由'''
+        self.count = 0
+        self.prepare_cmd = Dependent[None].parse(
+            call=_prepare_cmd, allow_types=Matcher.HANDLER_PARAM_TYPES
+        )
+        self.prepare_text = Dependent[None].parse(
+            call=_prepare_text, allow_types=Matcher.HANDLER_PARAM_TYPES
+        )
+
+    def add(self, box: "AyakaBox", func: Callable, cmds: list[str], states: list[str], always: bool, params: dict):
+        '''添加回调到路由表
+
+        参数:
+
+            box: 回调所属的盒子
+
+            func: 回调
+
+            cmds: 命令，为空时视为消息触发
+
+            states: 状态，*意味着对所有状态生效，为空时意味着群聊闲置状态
+
+            always: 是否总是触发
+
+            params: 其他参数，仅支持rule、permission、priority、block
+        '''
+        handler = AyakaHandler(box, func, bool(cmds), params, self.count)
+        self.count += 1
+
+        for cmd in cmds:
+            for start in get_driver().config.command_start:
+                self.trie.add(start + cmd, (start, cmd))
+
+        if always:
+            routes = [self.always]
+        elif not states:
+            routes = [self.idle]
+        else:
+            box_routes = self.box_routes.setdefault(box.name, {})
+            routes = [box_routes.setdefault(s, AyakaRoute()) for s in states]
+
+        for route in routes:
+            route.add(handler, cmds)
+
+    def get_routes(self, current_box: Optional["AyakaBox"], group_id: int):
+        '''获取当前群聊可能命中的路由'''
+        routes = [self.always]
+        if not current_box:
+            routes.append(self.idle)
+            return routes
+
+        box_routes = self.box_routes.get(current_box.name)
+        if box_routes:
+            state = current_box._get_state(group_id)
+            for key in (state, "*"):
+                route = box_routes.get(key)
+                if route:
+                    routes.append(route)
+        return routes
+
+    def parse_prefix(self, event: GroupMessageEvent):
+        '''在ayaka的命令前缀树中查找命令，返回与nonebot相同格式的解析结果'''
+        message = event.get_message()
+        if not message:
+            return
+        segment = message[0]
+        if not segment.is_text():
+            return
+
+        text = str(segment).lstrip()
+        found = self.trie.longest_prefix(text)
+        if not found:
+            return
+
+        length, (start, cmd) = found
+        msg = message.copy()
+        msg.pop(0)
+        new_message = msg.__class__(text[length:].lstrip())
+        for new_segment in reversed(new_message):
+            msg.insert(0, new_segment)
+
+        return {
+            CMD_KEY: (cmd,),
+            RAW_CMD_KEY: text[:length],
+            CMD_ARG_KEY: msg,
+            CMD_START_KEY: start,
+        }
+
+    def get_checker(self, priority: int):
+        '''生成该优先级的根matcher的rule'''
+        async def checker(bot: Bot, event: GroupMessageEvent, state: T_State):
+            return await self.check(bot, event, state, priority)
+        return Rule(checker)
+
+    async def check(self, bot: Bot, event: GroupMessageEvent, state: T_State, priority: int):
+        '''根matcher的rule，计算本次在该优先级需要运行的回调'''
+        group_id = event.group_id
+        if not state_backend.owns(group_id):
+            return False
+        current_box = self.get_current_box(group_id)
+        prefix = self.parse_prefix(event)
+        cmd = prefix[CMD_KEY][0] if prefix else None
+
+        candidates: list[AyakaHandler] = []
+        for route in self.get_routes(current_box, group_id):
+            if cmd:
+                candidates.extend(route.cmds.get(cmd, []))
+            candidates.extend(route.texts)
+        candidates = [h for h in candidates if h.priority == priority]
+
+        if not candidates:
+            return False
+
+        candidates.sort(key=lambda h: h.order)
+
+        # 同一优先级的回调都会运行，其中任意一个阻断时，由nonebot阻断更低优先级的matcher
+        selected: list[AyakaHandler] = []
+        block = False
+        for handler in candidates:
+            # 同一回调可能同时注册在多个命中的路由中
+            if selected and selected[-1] is handler:
+                continue
+            if group_id in handler.box._invalid_set:
+                continue
+            if not await handler.check(bot, event, state):
+                continue
+            selected.append(handler)
+            block = block or handler.block
+
+        if not selected:
+            return False
+
+        state[DISPATCH_KEY] = (prefix, selected, block)
+        return True
+
+    async def handle(self, matcher: Matcher, state: T_State):
+        '''根matcher的handler，将命中的回调插入到matcher的待运行队列中'''
+        _, selected, block = state[DISPATCH_KEY]
+        if block:
+            matcher.stop_propagation()
+
+        dependents: list[Dependent] = []
+        for handler in selected:
+            prepare = self.prepare_cmd if handler.is_cmd else self.prepare_text
+            dependents.append(prepare)
+            dependents.append(handler.dependent)
+
+        # nonebot 2.0.0正式版之后待运行队列更名为remain_handlers
+        if hasattr(matcher, "remain_handlers"):
+            handlers: list = matcher.remain_handlers
+        else:
+            handlers: list = matcher.handlers
+        handlers[0:0] = dependents
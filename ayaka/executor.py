@@ -0,0 +1,103 @@
+'''数据库执行器
+
+写操作在专用的写线程中排队执行，读操作在只读连接池中并发执行，避免阻塞事件循环
+'''
+import asyncio
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, TypeVar
+from .lazy import Path
+
+T = TypeVar("T")
+
+
+class AyakaDBExecutor:
+    '''数据库执行器
+
+    参数:
+
+        db: 写连接，同步API与写线程共用该连接
+
+        lock: 保护写连接的锁
+
+        path: 数据库文件地址，只读连接池通过它打开WAL模式下的只读连接
+
+        reader_count: 只读连接池的大小
+    '''
+
+    def __init__(self, db: sqlite3.Connection, lock: threading.RLock, path: Path, reader_count: int = 4) -> None:
+        self.db = db
+        self.lock = lock
+        self.uri = f"{path.resolve().as_uri()}?mode=ro"
+        self.reader_count = max(reader_count, 1)
+        self.local = threading.local()
+        self.readers: list[sqlite3.Connection] = []
+        self._writer: ThreadPoolExecutor | None = None
+        self._reader: ThreadPoolExecutor | None = None
+
+    @property
+    def writer(self):
+        '''专用写线程，其任务队列即写请求队列'''
+        if not self._writer:
+            self._writer = ThreadPoolExecutor(1, "ayaka-db-writer")
+        return self._writer
+
+    @property
+    def reader(self):
+        '''只读线程池'''
+        if not self._reader:
+            self._reader = ThreadPoolExecutor(
+                self.reader_count, "ayaka-db-reader")
+        return self._reader
+
+    def _get_reader_db(self):
+        '''获取当前读线程的只读连接'''
+        db: sqlite3.Connection | None = getattr(self.local, "db", None)
+        if not db:
+            db = sqlite3.connect(
+                self.uri, uri=True, check_same_thread=False)
+            self.local.db = db
+            self.readers.append(db)
+        return db
+
+    def _read(self, query: str, values=None):
+        cursor = self._get_reader_db().execute(query, values or ())
+        values = cursor.fetchall()
+        cursor.close()
+        return values
+
+    def _read_by_writer(self, query: str, values=None):
+        with self.lock:
+            cursor = self.db.execute(query, values or ())
+            values = cursor.fetchall()
+            cursor.close()
+        return values
+
+    async def write(self, func: Callable[..., T], *args, **kwargs) -> T:
+        '''在写线程中执行func'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.writer, partial(func, *args, **kwargs))
+
+    async def fetchall(self, query: str, values=None) -> list[tuple]:
+        '''执行查询
+
+        写连接存在未提交的事务时，只读连接看不到这些修改，因此交由写线程查询，以保证能读到自己的写入'''
+        loop = asyncio.get_running_loop()
+        if self.db.in_transaction:
+            return await loop.run_in_executor(self.writer, self._read_by_writer, query, values)
+        return await loop.run_in_executor(self.reader, self._read, query, values)
+
+    def shutdown(self):
+        '''等待所有排队的请求执行完毕，并关闭只读连接'''
+        if self._writer:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        if self._reader:
+            self._reader.shutdown(wait=True)
+            self._reader = None
+        for db in self.readers:
+            db.close()
+        self.readers.clear()
+        self.local = threading.local()
@@ -4,12 +4,18 @@ import functools
 import hashlib
 import json
 import re
-from time import time
+from collections import OrderedDict
+from math import ceil
+from time import monotonic, time
+from typing import Generic, Hashable, TypeVar
 
 import httpx
-from .lazy import get_driver, Message, MessageSegment, BaseModel, Path, logger
+from .lazy import get_driver, MessageSegment, BaseModel, Path, logger
 
 driver = get_driver()
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+T = TypeVar("T")
 
 
 def ensure_list(data: str | list | tuple | set):
@@ -102,6 +108,91 @@ class Timer:
             print(f"[{self.name}] 耗时{self.diff:.2f}s")
 
 
+class LRUCache(Generic[K, V]):
+    '''带有过期时间的LRU缓存
+
+    参数:
+
+        maxsize: 最大容量，超出时淘汰最久未使用的项，为0时不限容量
+
+        ttl: 过期时间（秒），从写入时开始计算，为0时永不过期
+
+    示例代码:
+    ```
+        cache = LRUCache(maxsize=100, ttl=60)
+        cache.put("a", 1)
+        cache.get("a")  # 1
+        cache.stats()   # {"size": 1, "hits": 1, "misses": 0, "evictions": 0}
+    ```
+    '''
+
+    def __init__(self, maxsize: int = 0, ttl: float = 0) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key: K):
+        return self.peek(key) is not None
+
+    def _expired(self, t: float):
+        return self.ttl > 0 and monotonic() - t > self.ttl
+
+    def peek(self, key: K) -> V | None:
+        '''获取缓存，不更新使用顺序和命中统计'''
+        item = self.data.get(key)
+        if item is None:
+            return None
+        t, value = item
+        if self._expired(t):
+            self.data.pop(key)
+            self.evictions += 1
+            return None
+        return value
+
+    def get(self, key: K) -> V | None:
+        '''获取缓存，若不存在或已过期则返回None'''
+        value = self.peek(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.data.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V):
+        '''写入缓存'''
+        self.data[key] = (monotonic(), value)
+        self.data.move_to_end(key)
+        if self.maxsize > 0:
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: K) -> V | None:
+        '''移除缓存'''
+        item = self.data.pop(key, None)
+        if item:
+            return item[1]
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self):
+        '''返回缓存统计'''
+        return {
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
 class SimpleUserInfo(BaseModel):
     '''简单用户信息'''
     id: int
@@ -109,12 +200,16 @@ class SimpleUserInfo(BaseModel):
 
 
 def find_user_by_uid(users: list, uid: int):
+    if not isinstance(users, list):
+        return users.find_by_uid(uid)
     for user in users:
         if uid == user["user_id"]:
             return user
 
 
 def find_user_by_uname(users: list, uname: str):
+    if not isinstance(users, list):
+        return users.find_by_uname(uname)
     for user in users:
         _uname = user["card"] or user["nickname"]
         if _uname == uname:
@@ -122,7 +217,9 @@ def find_user_by_uname(users: list, uname: str):
 
 
 def get_user(m: MessageSegment, users: list):
-    '''根据MessageSegment，自动通过uid/uname/[CQ:at]/@xxx四种可能的查找方式开始搜索对应user的信息'''
+    '''根据MessageSegment，自动通过uid/uname/[CQ:at]/@xxx四种可能的查找方式开始搜索对应user的信息
+
+    users可以是get_group_member_list的结果，也可以是ayaka_members提供的AyakaMemberIndex，后者无需遍历'''
     str_m = str(m)
 
     # [CQ:at]
@@ -150,23 +247,26 @@ def get_user(m: MessageSegment, users: list):
         return SimpleUserInfo(id=uid, name=uname)
 
 
-@singleton
-def _get_split_patt():
-    seps = driver.config.command_sep
-    seps = [re.escape(sep) for sep in seps]
-    return re.compile("|".join(seps))
+def paginate(items: list[T], page: int, size: int) -> tuple[list[T], int, int]:
+    '''分页
 
+    参数:
 
-def _command_args(msg: Message) -> list[str | MessageSegment]:
-    '''根据配置的分割符，分割消息为数组'''
-    items = []
-    for m in msg:
-        if m.type == "text":
-            ts = _get_split_patt().split(str(m))
-            items.extend(t for t in ts if t)
-        else:
-            items.append(m)
-    return items
+        items: 全部项目
+
+        page: 页码，从1开始，超出范围时取最近的一页
+
+        size: 每页的项目数，为0时不分页
+
+    返回:
+
+        该页的项目、实际页码、总页数
+    '''
+    if size <= 0:
+        return items, 1, 1
+    pages = max(ceil(len(items) / size), 1)
+    page = min(max(page, 1), pages)
+    return items[(page-1)*size: page*size], page, pages
 
 
 def pack_messages(user_id: int, user_name: str, messages: list):
@@ -8,6 +8,9 @@ except:
     logger.warning("ayaka意外地提前加载，其本应在nonebot2完成初始化之后才加载")
     nonebot.init()
 
+# ---- OneBot API 缓存 ----
+from . import apicache
+
 # ---- 盒子管理器 ----
 from . import master
 
@@ -0,0 +1,97 @@
+'''私聊监听
+
+将私聊消息转发给正在监听它的群聊，每个群聊使用独立的事件副本，并发处理，同时处理的群聊数量受listener_concurrency限制
+
+没有群聊监听该私聊时，matcher的rule直接返回False，不会进入事件处理流程
+'''
+import asyncio
+from time import time
+from .backend import state_backend
+from .config import ayaka_root_config
+from .lazy import Bot, GroupMessageEvent, PrivateMessageEvent, Rule, T_State, logger, on_message
+
+LISTENERS_KEY = "ayaka_listeners"
+'''rule查询到的群聊，保存在state中供handler使用'''
+
+
+class AyakaListener:
+    '''私聊监听'''
+
+    def __init__(self) -> None:
+        self.semaphore = asyncio.Semaphore(
+            max(ayaka_root_config.listener_concurrency, 1))
+        self.forwarded = 0
+        '''已转发的事件数'''
+
+    def add(self, user_id: int, group_id: int, ttl: float | None = None):
+        '''令群聊监听私聊
+
+        参数:
+
+            ttl: 有效期（秒），为None时使用根配置的listener_ttl，为0时永不过期
+        '''
+        if ttl is None:
+            ttl = ayaka_root_config.listener_ttl
+        expire = time() + ttl if ttl > 0 else 0
+        state_backend.add_listener(user_id, group_id, expire)
+
+    def remove(self, user_id: int, group_id: int):
+        '''令群聊取消监听私聊'''
+        state_backend.remove_listener(user_id, group_id)
+
+    def remove_all(self, group_id: int):
+        '''令群聊取消所有监听'''
+        state_backend.remove_listeners(group_id)
+
+    def get_groups(self, user_id: int):
+        '''获取正在监听该私聊、且由当前进程处理的群聊'''
+        return [
+            group_id for group_id in state_backend.get_listeners(user_id)
+            if state_backend.owns(group_id)
+        ]
+
+    async def forward(self, bot: Bot, event: PrivateMessageEvent, group_ids: list[int]):
+        '''将私聊消息转发给各群聊'''
+        base = GroupMessageEvent(
+            **event.dict(exclude={"message_type"}),
+            group_id=0,
+            message_type="group"
+        )
+
+        async def _forward(group_id: int):
+            # 各群聊的回调可能修改事件，因此使用深拷贝
+            _event = base.copy(deep=True, update={"group_id": group_id})
+            async with self.semaphore:
+                await bot.handle_event(_event)
+
+        results = await asyncio.gather(
+            *(_forward(group_id) for group_id in group_ids),
+            return_exceptions=True
+        )
+        self.forwarded += len(group_ids)
+        for group_id, result in zip(group_ids, results):
+            if isinstance(result, Exception):
+                logger.opt(exception=result, colors=True).error(
+                    f"转发私聊消息给群聊 <y>{group_id}</y> 失败")
+
+
+ayaka_listener = AyakaListener()
+'''ayaka私聊监听'''
+
+
+async def has_listeners(event: PrivateMessageEvent, state: T_State):
+    '''是否有群聊正在监听该私聊'''
+    group_ids = ayaka_listener.get_groups(event.user_id)
+    if not group_ids:
+        return False
+    state[LISTENERS_KEY] = group_ids
+    return True
+
+
+LISTEN = on_message(rule=Rule(has_listeners), block=False)
+'''处理监听转发的matcher'''
+
+
+@LISTEN.handle()
+async def listener_handle(bot: Bot, event: PrivateMessageEvent, state: T_State):
+    await ayaka_listener.forward(bot, event, state[LISTENERS_KEY])
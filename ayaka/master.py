@@ -1,5 +1,10 @@
 '''盒子管理器'''
-from .box import AyakaBox, get_box, box_list
+from nonebot.permission import SUPERUSER
+from .box import AyakaBox, get_box
+from .config import ayaka_root_config
+from .helpers import paginate
+from .profiler import ayaka_profiler
+from .registry import box_registry
 
 
 box = AyakaBox("盒子管理器")
@@ -10,7 +15,7 @@ box = AyakaBox("盒子管理器")
 async def list_box():
     '''展示所有盒子'''
     infos = ["已加载的盒子列表"]
-    for b in box_list:
+    for b in box_registry:
         info = f"- [{b.name}]"
         if not b.valid:
             info += " [已被屏蔽]"
@@ -18,17 +23,50 @@ async def list_box():
     await box.send("\n".join(infos))
 
 
+def get_page_arg():
+    '''若最后一个参数是页码，返回(页码, 其余参数)，否则页码为1'''
+    args = box.args
+    page = args.get_int(-1)
+    if page is None:
+        return 1, list(args)
+    return page, list(args[:-1])
+
+
+async def send_page(title: str, items: list[str], page: int, hint: str):
+    '''分页发送，非最后一页时提示如何翻页'''
+    items, page, pages = paginate(
+        items, page, ayaka_root_config.help_page_size)
+    if pages > 1:
+        title += f" 第{page}/{pages}页"
+        if page < pages:
+            items = [*items, f"使用命令 {hint} {page+1} 查看下一页"]
+    await box.send_many([title, *items])
+
+
 @box.on_cmd(cmds="盒子帮助", always=True)
 async def show_help():
-    '''展示盒子帮助'''
+    '''<盒子名或关键词> [页码] 展示盒子帮助，或在所有盒子中搜索命令'''
     if box.arg:
-        name = str(box.arg)
-        b = get_box(name)
+        # 先去掉页码，以免 盒子帮助 <盒子名> 2 查找不到盒子
+        page, args = get_page_arg()
+        keyword = " ".join(str(arg) for arg in args)
+        if not keyword:
+            keyword, page = str(box.arg), 1
+        b = get_box(keyword)
         if b:
             await box.send(b.help)
             return
+
+        entries = box_registry.search_help(keyword)
+        if entries:
+            await send_page(
+                f"包含 {keyword} 的命令",
+                [str(entry) for entry in entries],
+                page, f"盒子帮助 {keyword}"
+            )
         else:
-            await box.send("没有找到对应盒子")
+            await box.send("没有找到对应盒子或命令")
+        return
 
     b = box.current_box
     if b:
@@ -39,16 +77,18 @@ async def show_help():
     infos = [
         "如果想获得进一步帮助请使用命令",
         "- 盒子帮助 <盒子名>",
-        "- 全部盒子帮助"
+        "- 盒子帮助 <关键词>",
+        "- 全部盒子帮助 [页码]"
     ]
     await box.send("\n".join(infos))
 
 
 @box.on_cmd(cmds="全部盒子帮助", always=True)
-async def show_help():
-    '''展示展示所有盒子的帮助'''
-    infos = [b.help for b in box_list]
-    await box.send_many(infos)
+async def show_all_help():
+    '''[页码] 展示展示所有盒子的帮助'''
+    page, _ = get_page_arg()
+    infos = [b.help for b in box_registry]
+    await send_page("全部盒子帮助", infos, page, "全部盒子帮助")
 
 
 @box.on_cmd(cmds="盒子状态", always=True)
@@ -107,3 +147,10 @@ async def unblock_box():
 
     b.valid = True
     await box.send(f"已取消屏蔽盒子 {name}")
+
+
+@box.on_cmd(cmds="启动耗时", always=True, permission=SUPERUSER)
+async def show_startup_profile():
+    '''[数量] 展示各启动阶段耗时最长的项目，仅超级用户可用'''
+    top = box.args.get_int(0, 3)
+    await box.send(ayaka_profiler.summary(top))
@@ -0,0 +1,173 @@
+'''群成员目录
+
+缓存各bot在各群聊的成员列表，并建立按qq号、按群名片或昵称的索引，查找用户无需每次调用get_group_member_list，也无需遍历列表
+
+缓存过期后在下次查找时重新获取，同一群聊同时只获取一次；群成员增加、减少时增量更新
+'''
+import asyncio
+from .config import ayaka_root_config
+from .helpers import LRUCache, SimpleUserInfo, get_user
+from .lazy import Bot, MessageSegment, Rule, logger, get_driver
+from nonebot import on_notice
+from nonebot.adapters.onebot.v11 import GroupDecreaseNoticeEvent, GroupIncreaseNoticeEvent
+
+
+def get_member_name(user: dict) -> str:
+    '''成员的群名片，不存在时为昵称'''
+    return user["card"] or user["nickname"]
+
+
+class AyakaMemberIndex:
+    '''群成员索引，可代替成员列表传入get_user
+
+    参数:
+
+        users: get_group_member_list的结果
+    '''
+
+    def __init__(self, users: list[dict]) -> None:
+        self.by_uid: dict[int, dict] = {}
+        '''qq号 → 成员'''
+        self.by_name: dict[str, list[dict]] = {}
+        '''群名片或昵称 → 成员，重名时按加入索引的顺序排列'''
+        for user in users:
+            self.add(user)
+
+    def __len__(self):
+        return len(self.by_uid)
+
+    def __iter__(self):
+        return iter(self.by_uid.values())
+
+    def add(self, user: dict):
+        '''加入或更新成员'''
+        self.remove(user["user_id"])
+        self.by_uid[user["user_id"]] = user
+        self.by_name.setdefault(get_member_name(user), []).append(user)
+
+    def remove(self, uid: int):
+        '''移除成员'''
+        user = self.by_uid.pop(uid, None)
+        if not user:
+            return
+        name = get_member_name(user)
+        users = self.by_name[name]
+        users.remove(user)
+        if not users:
+            self.by_name.pop(name)
+
+    def find_by_uid(self, uid: int):
+        return self.by_uid.get(uid)
+
+    def find_by_uname(self, uname: str):
+        users = self.by_name.get(uname)
+        if users:
+            return users[0]
+
+
+class AyakaMemberDirectory:
+    '''群成员目录'''
+
+    def __init__(self) -> None:
+        self.cache: LRUCache[tuple[str, int], AyakaMemberIndex] = LRUCache(
+            ayaka_root_config.member_cache_max_groups,
+            ayaka_root_config.member_cache_ttl
+        )
+        '''(bot id, 群聊) → 成员索引'''
+        self.loading: dict[tuple[str, int], asyncio.Future] = {}
+        '''正在获取的成员列表'''
+        self.loads = 0
+        '''调用get_group_member_list的次数'''
+
+    async def get(self, bot: Bot, group_id: int) -> AyakaMemberIndex:
+        '''获取群成员索引，不存在或已过期时重新获取'''
+        key = (bot.self_id, group_id)
+        index = self.cache.get(key)
+        if index is not None:
+            return index
+
+        future = self.loading.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(bot, group_id))
+            self.loading[key] = future
+            future.add_done_callback(lambda _: self.loading.pop(key, None))
+
+        # 避免某个调用者被取消时，取消其他调用者共享的任务
+        return await asyncio.shield(future)
+
+    async def _load(self, bot: Bot, group_id: int):
+        users = await bot.get_group_member_list(group_id=group_id)
+        self.loads += 1
+        index = AyakaMemberIndex(users)
+        self.cache.put((bot.self_id, group_id), index)
+        return index
+
+    async def get_user(self, bot: Bot, group_id: int, m: MessageSegment | str) -> SimpleUserInfo | None:
+        '''根据MessageSegment，通过uid/uname/[CQ:at]/@xxx四种可能的查找方式，在群成员中查找对应user的信息'''
+        if isinstance(m, str):
+            m = MessageSegment.text(m)
+        return get_user(m, await self.get(bot, group_id))
+
+    def invalidate(self, bot_id: str, group_id: int):
+        '''丢弃群聊的成员缓存，下次查找时重新获取'''
+        self.cache.pop((bot_id, group_id))
+
+    async def on_increase(self, bot: Bot, group_id: int, user_id: int):
+        '''群成员增加时，获取其信息并加入已缓存的索引'''
+        index = self.cache.peek((bot.self_id, group_id))
+        if index is None:
+            return
+        try:
+            user = await bot.get_group_member_info(group_id=group_id, user_id=user_id)
+        except Exception as e:
+            logger.opt(exception=e, colors=True).warning(
+                f"获取群 <y>{group_id}</y> 新成员 <y>{user_id}</y> 的信息失败")
+            self.invalidate(bot.self_id, group_id)
+            return
+        index.add(user)
+
+    def on_decrease(self, bot: Bot, group_id: int, user_id: int):
+        '''群成员减少时，从已缓存的索引中移除；bot自身离开时丢弃整个群聊的缓存'''
+        if user_id == int(bot.self_id):
+            self.invalidate(bot.self_id, group_id)
+            return
+        index = self.cache.peek((bot.self_id, group_id))
+        if index is not None:
+            index.remove(user_id)
+
+    def stats(self):
+        '''返回缓存统计'''
+        return {**self.cache.stats(), "loads": self.loads}
+
+
+ayaka_members = AyakaMemberDirectory()
+'''ayaka群成员目录'''
+
+
+@get_driver().on_bot_disconnect
+async def clear_members(bot: Bot):
+    '''bot断开连接后，其缓存的成员列表不再可靠'''
+    for key in [key for key in ayaka_members.cache.data if key[0] == bot.self_id]:
+        ayaka_members.cache.pop(key)
+
+
+async def _is_increase(event: GroupIncreaseNoticeEvent):
+    return True
+
+
+async def _is_decrease(event: GroupDecreaseNoticeEvent):
+    return True
+
+
+MEMBER_INCREASE = on_notice(rule=Rule(_is_increase), block=False)
+MEMBER_DECREASE = on_notice(rule=Rule(_is_decrease), block=False)
+
+
+@MEMBER_INCREASE.handle()
+async def member_increase_handle(bot: Bot, event: GroupIncreaseNoticeEvent):
+    await ayaka_members.on_increase(bot, event.group_id, event.user_id)
+
+
+@MEMBER_DECREASE.handle()
+async def member_decrease_handle(bot: Bot, event: GroupDecreaseNoticeEvent):
+    ayaka_members.on_decrease(bot, event.group_id, event.user_id)
@@ -4,23 +4,45 @@
 
 不建议其他人用，以后会大改'''
 import asyncio
-import os
-import json
 import sqlite3
-from typing import Literal
+import threading
+import types
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Callable, Iterator, Literal, Union, get_args, get_origin
 from typing_extensions import Self
+from pydantic import PrivateAttr
+from nonebot.message import run_postprocessor
 
-from .helpers import run_in_startup
+from .helpers import LRUCache, run_in_startup
+from .profiler import ayaka_profiler
 from .lazy import get_driver, Field, BaseModel, logger
-from .config import data_path
+from .config import data_path, ayaka_root_config
+from .codec import get_codec
+from .executor import AyakaDBExecutor
+from .committer import AyakaDBCommitter
 
 PrimaryKey = {"primary": True}
 JsonKey = {"json": True}
+IndexKey = {"index": True}
 
 database_path = data_path / "ayaka.db"
-journal_path = data_path / "ayaka.db-journal"
 old_journal_path = data_path / "ayaka.db-journal-old"
-db = sqlite3.connect(database_path)
+db = sqlite3.connect(database_path, check_same_thread=False)
+'''写连接，同步API和写线程共用'''
+db.execute("PRAGMA journal_mode=WAL")
+db_lock = threading.RLock()
+'''保护写连接的锁'''
+executor = AyakaDBExecutor(
+    db, db_lock, database_path, ayaka_root_config.db_reader_count)
+'''异步API使用的执行器'''
+committer = AyakaDBCommitter(
+    db, db_lock,
+    max_latency=ayaka_root_config.db_commit_latency,
+    max_pending=ayaka_root_config.db_commit_pending,
+    checkpoint_interval=ayaka_root_config.db_checkpoint_interval
+)
+'''组提交调度器'''
 
 driver = get_driver()
 
@@ -43,147 +65,708 @@ def log_query(query, values=None):
             logger.debug(values)
 
 
+def note_write(cursor: sqlite3.Cursor):
+    '''登记写入，须在持有锁时调用；影响0行的语句同样开启了事务，因此至少计为1次'''
+    if db.in_transaction:
+        committer.note_write(max(cursor.rowcount, 1))
+
+
 def execute(query, values=None):
     log_query(query, values)
-    if values is None:
-        cursor = db.execute(query)
-    else:
-        cursor = db.execute(query, values)
-    cursor.close()
+    with db_lock:
+        if values is None:
+            cursor = db.execute(query)
+        else:
+            cursor = db.execute(query, values)
+        note_write(cursor)
+        cursor.close()
 
 
 def executemany(query, values=None):
     log_query(query, values)
-    if values is None:
-        cursor = db.executemany(query)
-    else:
-        cursor = db.executemany(query, values)
-    cursor.close()
+    with db_lock:
+        if values is None:
+            cursor = db.executemany(query)
+        else:
+            cursor = db.executemany(query, values)
+        note_write(cursor)
+        cursor.close()
 
 
-def fetchall(query: str):
-    cursor = db.execute(query)
-    values = cursor.fetchall()
-    cursor.close()
+def fetchall(query: str, values=None):
+    with db_lock:
+        cursor = db.execute(query, values or ())
+        values = cursor.fetchall()
+        cursor.close()
     log_query(query, values)
     return values
 
 
-table_names = []
+table_names: set[str] = set()
+'''已确认存在的表'''
+
+# 可以跳过pydantic校验、直接转换的列类型
+# 旧版以string声明字符串列，sqlite为其赋予NUMERIC亲和性，'2048'等文本会被存为整数，因此读取时仍需转换为str
+converters = {
+    "integer": None,
+    "string": str,
+    "number": float,
+    "boolean": bool,
+}
+
+column_types = {
+    "string": "text",
+}
+'''json schema类型 → 建表时使用的列类型，text列原样保存文本'''
+
+
+def is_plain_json_type(tp) -> bool:
+    '''该类型的值经过json编解码后是否保持不变，即无需pydantic校验即可还原
+
+    str键的dict、list及其嵌套的str、int、float、bool、None满足要求；int键的dict、tuple、set、BaseModel等不满足'''
+    if tp in (str, int, float, bool, type(None), Any, list, dict):
+        return True
+    origin = get_origin(tp)
+    args = get_args(tp)
+    if origin is list:
+        return all(is_plain_json_type(arg) for arg in args)
+    if origin is dict:
+        return (not args or args[0] is str) and all(is_plain_json_type(arg) for arg in args[1:])
+    if origin is Union or origin is types.UnionType:
+        return all(is_plain_json_type(arg) for arg in args)
+    return False
+
+
+class AyakaTable:
+    '''AyakaDB子类的表描述，首次使用时编译一次，缓存列信息和预先生成的sql语句'''
+
+    def __init__(self, cls: type["AyakaDB"]) -> None:
+        name = cls.__table_name__
+        if not name:
+            raise Exception("__table_name__不可为空")
+
+        self.cls = cls
+        self.name = name
+        self.props: dict[str, dict] = cls.schema()["properties"]
+        self.keys = list(self.props.keys())
+        '''列，与BaseModel字段顺序一致'''
+        self.primary_keys: list[str] = []
+        self.json_keys: list[str] = []
+        self.codec = get_codec(
+            cls.__json_codec__ or ayaka_root_config.db_json_codec)
+        '''json列的编解码器'''
+        self.indexes: list[tuple[str, ...]] = []
+        '''二级索引，包括单列索引和复合索引'''
+        self.converters: list[tuple[str, Callable]] = []
+        '''跳过校验时，需要转换类型的列'''
+        self.trusted = not (
+            cls.__validators__
+            or cls.__pre_root_validators__
+            or cls.__post_root_validators__
+        )
+        '''是否可以跳过pydantic校验，直接由数据库的值构造对象'''
+
+        args = []
+        for k, v in self.props.items():
+            extra: dict = v.get("extra", {})
+            if extra.get("primary"):
+                self.primary_keys.append(k)
+            if extra.get("index"):
+                self.indexes.append((k,))
+            if extra.get("json"):
+                self.json_keys.append(k)
+                args.append(f"{k} text")
+                # 例如BaseModel、int键的dict，需要经过校验才能还原
+                if not is_plain_json_type(cls.__fields__[k].outer_type_):
+                    self.trusted = False
+                continue
+
+            args.append(f"{k} {column_types.get(v['type'], v['type'])}")
+            if v["type"] not in converters or "format" in v:
+                self.trusted = False
+            elif converters[v["type"]]:
+                self.converters.append((k, converters[v["type"]]))
+
+        if self.primary_keys:
+            primarys_str = ",".join(f"\"{k}\"" for k in self.primary_keys)
+            args.append(f"PRIMARY KEY({primarys_str})")
+
+        for columns in cls.__indexes__:
+            columns = tuple(columns)
+            for k in columns:
+                if k not in self.props:
+                    raise Exception(f"索引 {columns} 中的列 {k} 不存在")
+            if columns not in self.indexes:
+                self.indexes.append(columns)
+
+        args_str = ",\n".join(args)
+        self.create_query = f"create table if not exists \"{name}\" ({args_str})"
+        self.index_queries = [
+            get_index_query(name, columns)
+            for columns in self.indexes
+        ]
+        self.insert_query = get_insert_query(name, self.keys, "insert")
+        self.replace_query = get_insert_query(name, self.keys, "replace")
+        self.select_query = f"select {','.join(self.keys)} from \"{name}\""
+        self.delete_query = f"delete from \"{name}\""
+        self.base_queries = {
+            "select": self.select_query,
+            "rowid": f"select rowid,{','.join(self.keys)} from \"{name}\"",
+            "delete": self.delete_query,
+        }
+        '''语句类型 → 不含筛选条件的语句，rowid类型在各行之前额外返回rowid'''
+        self.upsert_queries: dict[tuple[str, ...], str] = {}
+        self.increment_queries: dict[tuple[str, ...], str] = {}
+        self.primary_indexes = [self.keys.index(k) for k in self.primary_keys]
+        self.json_indexes = [self.keys.index(k) for k in self.json_keys]
+        self.cache: LRUCache[tuple, AyakaDB] | None = None
+        '''身份映射，仅在设置了__cache_size__且存在主键时启用'''
+        if cls.__cache_size__ > 0 and self.primary_keys:
+            self.cache = LRUCache(cls.__cache_size__, cls.__cache_ttl__)
+        self.where_queries: dict[tuple, str] = {}
+        '''(语句类型, 筛选条件的形状) → 语句'''
+
+    def get_where_args(self, action: Literal["select", "rowid", "delete"], params: dict):
+        '''生成参数化的语句，按语句类型和筛选条件的形状缓存
+
+        参数:
+
+            action: 语句类型
+
+            params: 列名 → 值，值为None时筛选该列为null的行
+
+        返回:
+
+            语句与参数
+
+        异常:
+
+            列不存在
+        '''
+        shape = (action, tuple((k, v is None) for k, v in params.items()))
+        query = self.where_queries.get(shape)
+        if not query:
+            query = self.base_queries[action]
+            conditions = []
+            for k, is_null in shape[1]:
+                if k not in self.props:
+                    raise Exception(f"表 {self.name} 中不存在列 {k}")
+                conditions.append(f"\"{k}\" is null" if is_null else f"\"{k}\"=?")
+            if conditions:
+                query += " where " + " and ".join(conditions)
+            self.where_queries[shape] = query
+
+        values = [v for v in params.values() if v is not None]
+        return query, values
+
+    def get_order(self, order_by: str | list[str]):
+        '''解析排序的列，列名前加"-"表示降序
+
+        返回:
+
+            [(列名, 是否降序), ...]
+
+        异常:
+
+            列不存在
+        '''
+        if isinstance(order_by, str):
+            order_by = [order_by]
+        order: list[tuple[str, bool]] = []
+        for k in order_by:
+            desc = k.startswith("-")
+            k = k.lstrip("-")
+            if k not in self.props and k != "rowid":
+                raise Exception(f"表 {self.name} 中不存在列 {k}")
+            order.append((k, desc))
+        return order
+
+    def get_select_args(self, params: dict, order_by: str | list[str] = [], limit: int = 0, offset: int = 0, after: tuple | None = None, action: Literal["select", "rowid"] = "select"):
+        '''生成带排序和分页的查询语句
+
+        参数:
+
+            params: 筛选条件，同get_where_args
+
+            order_by: 排序的列，列名前加"-"表示降序，为空时按主键升序
+
+            limit: 最多返回的行数，为0时不限制
+
+            offset: 跳过的行数
+
+            after: 键集分页，只返回排在该值之后的行，其值依次对应排序的列
+
+            action: 语句类型
+
+        返回:
+
+            语句与参数
+
+        异常:
+
+            after的长度与排序的列数不一致，或各列的排序方向不一致
+        '''
+        query, values = self.get_where_args(action, params)
+        if order_by:
+            order = self.get_order(order_by)
+        else:
+            order = [(k, False) for k in self.primary_keys]
+
+        if after is not None:
+            if len(after) != len(order):
+                raise Exception(f"after的长度与排序的列 {order} 不一致")
+            if len({desc for _, desc in order}) > 1:
+                raise Exception("键集分页要求各列的排序方向一致")
+            columns = ",".join(f"\"{k}\"" for k, _ in order)
+            marks = ",".join("?" for _ in order)
+            op = "<" if order[0][1] else ">"
+            query += " and " if params else " where "
+            query += f"({columns}) {op} ({marks})"
+            values.extend(after)
+
+        if order:
+            query += " order by " + ",".join(
+                f"\"{k}\" desc" if desc else f"\"{k}\""
+                for k, desc in order
+            )
+        if limit > 0 or offset > 0:
+            query += " limit ? offset ?"
+            values.extend([limit if limit > 0 else -1, offset])
+        return query, values
+
+    def get_upsert_query(self, columns: tuple[str, ...]):
+        '''插入新行，若主键冲突则只更新columns中的列'''
+        query = self.upsert_queries.get(columns)
+        if not query:
+            query = get_upsert_query(
+                self.name, self.keys, self.primary_keys, columns)
+            self.upsert_queries[columns] = query
+        return query
+
+    def check_columns(self, columns: tuple[str, ...], allow_primary: bool = True):
+        '''检查列是否存在
+
+        异常:
+
+            列不存在，或不允许修改主键时包含主键
+        '''
+        for k in columns:
+            if k not in self.props:
+                raise Exception(f"表 {self.name} 中不存在列 {k}")
+            if not allow_primary and k in self.primary_keys:
+                raise Exception(f"不可修改表 {self.name} 的主键 {k}")
+
+    def is_primary_params(self, params: dict):
+        '''筛选条件是否恰好为全部主键'''
+        return bool(self.primary_keys) and len(params) == len(self.primary_keys) \
+            and all(k in params for k in self.primary_keys)
+
+    def get_increment_query(self, columns: tuple[str, ...]):
+        '''插入新行，若主键冲突则令columns中的列各自加上给定的值
+
+        异常:
+
+            表没有主键，或列不存在
+        '''
+        query = self.increment_queries.get(columns)
+        if not query:
+            if not self.primary_keys:
+                raise Exception(f"表 {self.name} 没有主键，无法原子地更新")
+            self.check_columns(columns, False)
+            primarys_str = ",".join(f"\"{k}\"" for k in self.primary_keys)
+            sets = ",".join(f"\"{c}\"=\"{c}\"+?" for c in columns)
+            query = f"{self.insert_query} on conflict({primarys_str}) do update set {sets}"
+            self.increment_queries[columns] = query
+        return query
+
+    def to_row(self, data: "AyakaDB"):
+        '''按列的顺序返回对象的值，尚未解码的json列直接使用数据库中的原始数据'''
+        values = data.__dict__
+        raw = data._raw
+        row = [values.get(k) for k in self.keys]
+        for k, i in zip(self.json_keys, self.json_indexes):
+            row[i] = raw[k] if k in raw else self.codec.encode(row[i])
+        return row
+
+    def get_cache_key(self, params: dict):
+        '''若筛选条件恰好为全部主键，则返回身份映射的键，否则返回None'''
+        if self.cache is None or not self.is_primary_params(params):
+            return None
+        return tuple(params[k] for k in self.primary_keys)
+
+    def cache_data(self, data: "AyakaDB"):
+        '''写入后，令身份映射持有该对象'''
+        if self.cache is not None:
+            key = tuple(getattr(data, k) for k in self.primary_keys)
+            self.cache.put(key, data)
+
+    def uncache(self, params: dict):
+        '''删除后，移除身份映射中可能受影响的对象'''
+        if self.cache is None:
+            return
+        key = self.get_cache_key(params)
+        if key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(key)
 
+    def to_data(self, row: tuple | list):
+        '''将数据库的一行转换为对象'''
+        data = dict(zip(self.keys, row))
+        if not self.trusted:
+            for k in self.json_keys:
+                data[k] = self.codec.decode(data[k])
+            return self.cls(**data)
 
-def create_table(name: str, cls: type["AyakaDB"]):
-    if not name:
-        raise Exception("__table_name__不可为空")
+        # json列在首次访问时才解码
+        raw = {k: data.pop(k) for k in self.json_keys}
+
+        for k, func in self.converters:
+            v = data[k]
+            if v is not None:
+                data[k] = func(v)
 
+        # 等效于construct，数据库中的值在写入前已经过校验
+        obj = self.cls.__new__(self.cls)
+        object.__setattr__(obj, "__dict__", data)
+        object.__setattr__(obj, "__fields_set__", set(self.keys))
+        obj._init_private_attributes()
+        if raw:
+            obj._raw.update(raw)
+        return obj
+
+
+tables: dict[type["AyakaDB"], AyakaTable] = {}
+'''AyakaDB子类 → 表描述'''
+
+
+def get_table(cls: type["AyakaDB"]):
+    table = tables.get(cls)
+    if not table:
+        table = AyakaTable(cls)
+        tables[cls] = table
+    return table
+
+
+def create_table(name: str, cls: type["AyakaDB"]):
     if name in table_names:
         return
-    table_names.append(name)
+    with ayaka_profiler.measure("table", name):
+        table = get_table(cls)
+        execute(table.create_query)
+        for query in table.index_queries:
+            execute(query)
+    table_names.add(name)
 
-    props = cls.props()
-    args = []
-    primarys = []
-
-    for k, v in props.items():
-        extra: dict = v.get("extra", {})
-        if extra.get("primary"):
-            primarys.append(k)
-        if extra.get("json"):
-            args.append(f"{k} text")
-        else:
-            args.append(f"{k} {v['type']}")
-            
-    if primarys:
-        primarys_str = ",".join(f"\"{k}\"" for k in primarys)
-        args.append(f"PRIMARY KEY({primarys_str})")
 
-    args_str = ",\n".join(args)
-    query = f"create table if not exists \"{name}\" ({args_str})"
+def get_index_query(name: str, columns: tuple[str, ...]):
+    index_name = f"ix_{name}_{'_'.join(columns)}"
+    columns_str = ",".join(f"\"{k}\"" for k in columns)
+    return f"create index if not exists \"{index_name}\" on \"{name}\" ({columns_str})"
 
-    execute(query)
+
+def get_insert_query(name: str, keys: list[str], action: Literal["insert", "replace"]):
+    keys_str = ",".join(keys)
+    values_str = ("(?),"*len(keys))[:-1]
+    return f"{action} into \"{name}\" ({keys_str}) values ({values_str})"
+
+
+def get_insert_args(name: str, data: "AyakaDB", action: Literal["insert", "replace"]):
+    '''返回语句和参数，参数在调用时生成快照，之后修改对象不会影响写入'''
+    table = get_table(data.__class__)
+    query = table.insert_query if action == "insert" else table.replace_query
+    return query, table.to_row(data)
+
+
+def get_insert_many_args(name: str, datas: list["AyakaDB"], action: Literal["insert", "replace"]):
+    table = get_table(datas[0].__class__)
+    query = table.insert_query if action == "insert" else table.replace_query
+    return query, [table.to_row(data) for data in datas]
 
 
 def insert_or_replace(name: str, data: "AyakaDB", action: Literal["insert", "replace"]):
     create_table(name, data.__class__)
-
-    keys = list(data.dict().keys())
-    values = list(data.dict().values())
-    keys_str = ",".join(keys)
-    values_str = ("(?),"*len(keys))[:-1]
-    query = f"{action} into \"{name}\" ({keys_str}) values ({values_str})"
-    execute(query, values)
+    execute(*get_insert_args(name, data, action))
+    get_table(data.__class__).cache_data(data)
 
 
 def insert_or_replace_many(name: str, datas: list["AyakaDB"], action: Literal["insert", "replace"]):
     create_table(name, datas[0].__class__)
+    executemany(*get_insert_many_args(name, datas, action))
+    table = get_table(datas[0].__class__)
+    for data in datas:
+        table.cache_data(data)
 
-    data = datas[0]
-    keys = list(data.dict().keys())
-    values = [[getattr(data, k) for k in keys] for data in datas]
-    keys_str = ",".join(keys)
-    values_str = ("(?),"*len(keys))[:-1]
-    query = f"{action} into \"{name}\" ({keys_str}) values ({values_str})"
-    executemany(query, values)
 
+def get_upsert_query(name: str, keys: list[str], primarys: list[str], columns: list[str]):
+    '''插入新行，若主键冲突则只更新columns中的列'''
+    if not primarys:
+        return get_insert_query(name, keys, "replace")
+
+    query = get_insert_query(name, keys, "insert")
+    primarys_str = ",".join(f"\"{k}\"" for k in primarys)
+    columns = [c for c in columns if c not in primarys]
+    if not columns:
+        return f"{query} on conflict({primarys_str}) do nothing"
 
-def delete(name: str, cls: type["AyakaDB"], extra: str = ""):
+    sets = ",".join(f"\"{c}\"=excluded.\"{c}\"" for c in columns)
+    return f"{query} on conflict({primarys_str}) do update set {sets}"
+
+
+def execute_with_table(name: str, cls: type["AyakaDB"], query: str, values=None, many: bool = False):
+    '''确保表存在后执行语句，供写线程使用'''
     create_table(name, cls)
-    query = f"delete from \"{name}\" {extra}"
-    execute(query)
+    if many:
+        executemany(query, values)
+    else:
+        execute(query, values)
 
 
-def select_many(name: str, cls: type["AyakaDB"], extra: str = ""):
+def upsert(name: str, cls: type["AyakaDB"], data: "AyakaDB", columns: tuple[str, ...]):
+    '''插入data，若主键冲突则只更新columns中的列'''
     create_table(name, cls)
+    table = get_table(cls)
+    execute(table.get_upsert_query(columns), table.to_row(data))
 
-    props = cls.props()
-    keys = list(props.keys())
-    keys_str = ",".join(keys)
-    query = f"select {keys_str} from \"{name}\" {extra}"
-    values = fetchall(query)
-
-    # 组装为字典
-    datas = [
-        cls._create_by_db_data({k: v for k, v in zip(keys, vs)})
-        for vs in values
-    ]
+
+def increment(name: str, cls: type["AyakaDB"], keys: dict, deltas: dict):
+    '''令主键为keys的行的各列原子地加上deltas中的值，行不存在时以默认值为基础插入'''
+    create_table(name, cls)
+    table = get_table(cls)
+    columns = tuple(deltas)
+    query = table.get_increment_query(columns)
+    row = table.to_row(cls(**keys))
+    for k, v in deltas.items():
+        row[table.keys.index(k)] += v
+    execute(query, row + list(deltas.values()))
+
+
+def get_or_create(name: str, cls: type["AyakaDB"], params: dict):
+    '''在一次持有锁的过程中插入（主键冲突时忽略）并读取该行，不会与其他写入交错'''
+    create_table(name, cls)
+    table = get_table(cls)
+    if not table.is_primary_params(params):
+        raise Exception(f"get_or_create需要且只需要提供表 {table.name} 的全部主键")
+    row = table.to_row(cls(**params))
+    with db_lock:
+        execute(table.get_upsert_query(()), row)
+        rows = fetchall(*table.get_where_args("select", params))
+    return table.to_data(rows[0])
+
+
+def delete(name: str, cls: type["AyakaDB"], params: dict = {}):
+    '''可能在写线程中执行，因此不修改身份映射，由调用者在事件循环中移除缓存'''
+    create_table(name, cls)
+    table = get_table(cls)
+    execute(*table.get_where_args("delete", params))
+
+
+def build_datas(cls: type["AyakaDB"], values: list[tuple]):
+    table = get_table(cls)
+    if table.cache is None:
+        return [table.to_data(vs) for vs in values]
+
+    # 身份映射中已存在的行，直接返回同一个对象
+    datas = []
+    for vs in values:
+        data = table.cache.peek(tuple(vs[i] for i in table.primary_indexes))
+        if data is None:
+            data = table.to_data(vs)
+        datas.append(data)
+    return datas
+
+
+def select_many(name: str, cls: type["AyakaDB"], params: dict = {}):
+    table = get_table(cls)
+    key = table.get_cache_key(params)
+    if key is not None:
+        data = table.cache.get(key)
+        if data is not None:
+            return [data]
+
+    create_table(name, cls)
+    values = fetchall(*table.get_where_args("select", params))
+    datas = build_datas(cls, values)
+    if key is not None and datas:
+        table.cache.put(key, datas[0])
     return datas
 
 
+async def aselect_many(name: str, cls: type["AyakaDB"], params: dict = {}):
+    table = get_table(cls)
+    key = table.get_cache_key(params)
+    if key is not None:
+        data = table.cache.get(key)
+        if data is not None:
+            return [data]
+
+    if name not in table_names:
+        await executor.write(create_table, name, cls)
+    query, values = table.get_where_args("select", params)
+    values = await executor.fetchall(query, values)
+    log_query(query, values)
+    datas = build_datas(cls, values)
+    if key is not None and datas:
+        table.cache.put(key, datas[0])
+    return datas
+
+
+def select_page(name: str, cls: type["AyakaDB"], params: dict = {}, order_by: str | list[str] = [], limit: int = 0, offset: int = 0, after: tuple | None = None):
+    create_table(name, cls)
+    query, values = get_table(cls).get_select_args(
+        params, order_by, limit, offset, after)
+    return build_datas(cls, fetchall(query, values))
+
+
+async def aselect_page(name: str, cls: type["AyakaDB"], params: dict = {}, order_by: str | list[str] = [], limit: int = 0, offset: int = 0, after: tuple | None = None):
+    if name not in table_names:
+        await executor.write(create_table, name, cls)
+    query, values = get_table(cls).get_select_args(
+        params, order_by, limit, offset, after)
+    values = await executor.fetchall(query, values)
+    log_query(query, values)
+    return build_datas(cls, values)
+
+
+def get_batch_args(table: AyakaTable, params: dict, batch_size: int, after: tuple | None):
+    '''分批读取时按主键做键集分页，没有主键时按rowid分页'''
+    if table.primary_keys:
+        return table.get_select_args(params, limit=batch_size, after=after)
+    return table.get_select_args(params, "rowid", batch_size, after=after, action="rowid")
+
+
+def split_batch(table: AyakaTable, rows: list[tuple]):
+    '''返回下一批的起点和本批的行'''
+    if table.primary_keys:
+        return tuple(rows[-1][i] for i in table.primary_indexes), rows
+    return (rows[-1][0],), [row[1:] for row in rows]
+
+
+def iter_batches(name: str, cls: type["AyakaDB"], params: dict = {}, batch_size: int = 500, raw: bool = False):
+    '''逐批读取，每批单独查询，不会在批次之间持有锁'''
+    create_table(name, cls)
+    table = get_table(cls)
+    after = None
+    while True:
+        rows = fetchall(*get_batch_args(table, params, batch_size, after))
+        if not rows:
+            return
+        after, rows = split_batch(table, rows)
+        yield rows if raw else build_datas(cls, rows)
+        if len(rows) < batch_size:
+            return
+
+
+async def aiter_batches(name: str, cls: type["AyakaDB"], params: dict = {}, batch_size: int = 500, raw: bool = False):
+    if name not in table_names:
+        await executor.write(create_table, name, cls)
+    table = get_table(cls)
+    after = None
+    while True:
+        query, values = get_batch_args(table, params, batch_size, after)
+        rows = await executor.fetchall(query, values)
+        if not rows:
+            return
+        after, rows = split_batch(table, rows)
+        yield rows if raw else build_datas(cls, rows)
+        if len(rows) < batch_size:
+            return
+
+
 def drop_table(name: str):
     query = f"drop table if exists \"{name}\""
     execute(query)
+    table_names.discard(name)
+    for table in tables.values():
+        if table.name == name and table.cache is not None:
+            table.cache.clear()
 
 
-async def loop():
-    while True:
-        commit()
-        await asyncio.sleep(10)
+current_batch: ContextVar[dict[int, "AyakaDB"] | None] = ContextVar(
+    "ayaka_db_batch", default=None)
+'''当前上下文中最外层AyakaDB.batch()修改的对象，不在batch中时为None'''
+dirty_datas: dict[int, "AyakaDB"] = {}
+'''在batch之外修改了字段但尚未写入的对象（__autoflush__为False时）'''
 
 
-@run_in_startup
-async def create_loop():
-    asyncio.create_task(loop())
+def get_flush_args(datas: dict[int, "AyakaDB"] | None = None):
+    '''取出待写入的对象，按类和修改过的列分组，每组生成一条语句
+
+    参数:
+
+        datas: 待写入的对象，为None时取出所有在batch之外被标记为脏的对象
+
+    返回:
+
+        (表名, 类, 语句, 参数列表)的列表
+    '''
+    if datas is None:
+        datas = dirty_datas
+    groups: dict[tuple, list[AyakaDB]] = {}
+    for i, data in datas.items():
+        if datas is not dirty_datas:
+            dirty_datas.pop(i, None)
+        # 可能已在其他batch中写入
+        if not data._dirty:
+            continue
+        key = (data.__class__, tuple(sorted(data._dirty)))
+        groups.setdefault(key, []).append(data)
+        data._dirty.clear()
+    datas.clear()
+
+    args = []
+    for (cls, columns), datas in groups.items():
+        table = get_table(cls)
+        values = [table.to_row(data) for data in datas]
+        query = table.get_upsert_query(columns)
+        args.append((table.name, cls, query, values))
+    return args
+
+
+def flush(datas: dict[int, "AyakaDB"] | None = None):
+    '''立即写入待写入的对象，datas为None时写入所有在batch之外被标记为脏的对象'''
+    for name, cls, query, values in get_flush_args(datas):
+        execute_with_table(name, cls, query, values, True)
+
+
+async def aflush():
+    '''flush的异步版本'''
+    for name, cls, query, values in get_flush_args():
+        await executor.write(execute_with_table, name, cls, query, values, True)
+
+
+@run_postprocessor
+async def flush_after_handler():
+    '''回调结束后，写入本次回调中修改的数据'''
+    if dirty_datas:
+        await aflush()
 
 
 def commit():
-    if old_journal_path.exists():
-        os.remove(old_journal_path)
-        logger.debug("已删除旧db-journal-old文件")
-    if journal_path.exists():
-        logger.debug("更新数据库")
-        db.commit()
+    '''立即提交，返回是否提交成功'''
+    return committer.commit()
+
+
+def get_commit_stats():
+    '''返回提交统计'''
+    return committer.get_stats()
 
-        # 提交失败，直接删除
-        if journal_path.exists():
-            logger.debug("更新数据库失败，已将journal文件更名为db-journal-old")
-            journal_path.rename(old_journal_path)
+
+@run_in_startup
+async def create_loop():
+    # 旧版在提交失败时会遗留该文件
+    if old_journal_path.exists():
+        old_journal_path.unlink()
+    asyncio.create_task(committer.run(executor.write, aflush))
 
 
-def wrap(v):
-    '''给字符串包裹上双引号'''
-    if isinstance(v, str):
-        return f"\"{v}\""
-    return str(v)
+@driver.on_shutdown
+async def close_executor():
+    '''等待写线程中排队的请求执行完毕，写入所有被标记为脏的对象，然后提交并截断WAL文件'''
+    executor.shutdown()
+    flush()
+    commit()
+    committer.checkpoint("TRUNCATE")
 
 
 class AyakaDB(BaseModel):
@@ -196,46 +779,158 @@ class AyakaDB(BaseModel):
     4. 一些特殊类型的数据请设置其为json形式存取 
         <name>:<type> = Field(extra=AyakaDB.__json_key__)
         AyakaDB在写入时会自动序列化该数据为字符串，写入数据库，读取时则相反
-    5. 若需要编写自定义读写数据方法，可以使用AyakaDB.get_db()方法获取sqlite3.Connection对象
+        读取时json列在首次访问时才解码，未访问过的列写入时直接使用原始数据，不再重新编码
+        可通过 __json_codec__ 或根配置的db_json_codec选择编解码器（json、orjson、zlib），也可以通过ayaka.codec.register_codec注册自定义编解码器
+    4.1 设置二级索引需要使用
+        <name>:<type> = Field(extra=AyakaDB.__index_key__)
+        复合索引请书写 __indexes__ = [("列1", "列2"), ...]
+    5. 若需要编写自定义读写数据方法，可以使用AyakaDB.get_db()方法获取sqlite3.Connection对象，使用时请持有AyakaDB.get_lock()
+    6. 在异步回调中建议使用aselect_many、aselect_one、asave等异步API，它们在后台线程中执行，不会阻塞事件循环
+    7. 设置 __cache_size__ 后启用按主键的身份映射，按全部主键查询时直接返回缓存中的同一个对象，cache_stats()可查看命中统计
+        通过get_db()自行修改数据时，身份映射不会感知，请避免与身份映射混用
+    8. 遍历大表时请使用iterate/iter_batches逐批读取，需要排序或分页时使用select_page
+        这些方法的关键字参数order_by、limit、offset、after、batch_size、raw不会被视为筛选条件
+    9. 只修改部分列时请使用upsert，计数类的修改请使用increment/decrement，它们只写入给定的列，不会覆盖并发的修改
     ```
     '''
     __table_name__ = ""
     __primary_key__ = PrimaryKey
     __json_key__ = JsonKey
+    __index_key__ = IndexKey
+    __indexes__: list[tuple[str, ...]] = []
+    '''复合索引，每一项为一个索引包含的列'''
+    __cache_size__ = 0
+    '''身份映射的容量，大于0时按主键缓存对象，重复按主键查询时直接返回同一个对象，不再访问数据库'''
+    __cache_ttl__: float = 0
+    '''身份映射中对象的过期时间（秒），为0时永不过期'''
+    __autoflush__ = True
+    '''为False时，修改属性只将其标记为脏，在回调结束后或定期合并写入'''
+
+    __json_codec__ = ""
+    '''json列的编解码器名称，为空时使用根配置的db_json_codec'''
+
+    _dirty: set[str] = PrivateAttr(default_factory=set)
+    '''修改过但尚未写入的字段'''
+    _raw: dict[str, str | bytes] = PrivateAttr(default_factory=dict)
+    '''尚未解码的json列的原始数据'''
 
     @classmethod
     def props(cls) -> dict[str, dict]:
-        return cls.schema()["properties"]
+        # 未设置表名的中间基类没有表描述
+        if not cls.__table_name__:
+            return cls.schema()["properties"]
+        return get_table(cls).props
+
+    def __getattr__(self, name: str):
+        # 首次访问尚未解码的json列时解码，之后该值可能被原地修改，因此不再保留原始数据
+        if not name.startswith("_") and name in self._raw:
+            value = get_table(self.__class__).codec.decode(
+                self._raw.pop(name))
+            self.__dict__[name] = value
+            return value
+        raise AttributeError(
+            f"'{self.__class__.__name__}' object has no attribute '{name}'")
+
+    def _decode_all(self):
+        '''解码所有尚未解码的json列，并恢复字段的顺序'''
+        if not self._raw:
+            return
+        for k in list(self._raw):
+            getattr(self, k)
+        values = self.__dict__
+        object.__setattr__(
+            self, "__dict__", {k: values[k] for k in self.__fields__ if k in values})
 
     def __setattr__(self, name, value):
         super().__setattr__(name, value)
-        self.save()
+        if name.startswith("_"):
+            return
+
+        self._raw.pop(name, None)
+
+        batch = current_batch.get()
+        if batch is not None:
+            self._dirty.add(name)
+            batch[id(self)] = self
+        elif not self.__autoflush__:
+            self._dirty.add(name)
+            dirty_datas[id(self)] = self
+        else:
+            self.save()
 
     @classmethod
-    def _create_by_db_data(cls, data: dict):
-        props = cls.props()
+    @contextmanager
+    def batch(cls):
+        '''在with块中修改属性只将其标记为脏，退出最外层with块时，每个对象只写入一次修改过的列
+
+        只写入当前上下文的with块中修改的对象，不影响其他并发回调中尚未结束的batch
+
+        示例代码:
+        ```
+            with User.batch():
+                user.gold += 1
+                user.exp += 10
+                user.level = 2
+            # 退出时只执行一次写入
+        ```
+        '''
+        if current_batch.get() is not None:
+            yield
+            return
+
+        batch: dict[int, AyakaDB] = {}
+        token = current_batch.set(batch)
+        try:
+            yield
+        finally:
+            current_batch.reset(token)
+            flush(batch)
 
-        # 特殊处理json
-        for k, v in props.items():
-            extra: dict = v.get("extra", {})
-            if extra.get("json"):
-                if k in data:
-                    data[k] = json.loads(data[k])
+    @classmethod
+    def flush(cls):
+        '''立即写入当前batch中与batch之外被标记为脏的对象'''
+        batch = current_batch.get()
+        if batch:
+            flush(batch)
+        flush()
 
-        return cls(**data)
+    @classmethod
+    def _create_by_db_data(cls, data: dict):
+        table = get_table(cls)
+        return table.to_data([data[k] for k in table.keys])
 
     def dict(self, **params):
+        if not self.__table_name__:
+            return super().dict(**params)
+        table = get_table(self.__class__)
+        raw = self._raw
+        if params:
+            self._decode_all()
+            raw = {}
         data = super().dict(**params)
-        props = self.props()
 
-        # 特殊处理json
-        for k, v in props.items():
-            extra: dict = v.get("extra", {})
-            if extra.get("json"):
-                if k in data:
-                    data[k] = json.dumps(data[k], ensure_ascii=0)
+        # 特殊处理json，未解码的列直接使用原始数据
+        for k in table.json_keys:
+            if k in raw:
+                data[k] = raw[k]
+            elif k in data:
+                data[k] = table.codec.encode(data[k])
+        if raw:
+            data = {k: data[k] for k in table.keys if k in data}
         return data
 
+    def json(self, **params):
+        self._decode_all()
+        return super().json(**params)
+
+    def copy(self, **params):
+        self._decode_all()
+        return super().copy(**params)
+
+    def __repr_args__(self):
+        self._decode_all()
+        return super().__repr_args__()
+
     @classmethod
     def drop_table(cls):
         drop_table(cls.__table_name__)
@@ -264,35 +959,23 @@ class AyakaDB(BaseModel):
     @classmethod
     def delete(cls, **params) -> list[Self]:
         '''按照params的值删除数据，若params为空，则删除全部'''
-        extra = ""
-        if params:
-            where = " and ".join(
-                f"{k}={wrap(v)}"
-                for k, v in params.items()
-            )
-            extra = f"where {where}"
-
-        return delete(cls.__table_name__, cls, extra)
+        get_table(cls).uncache(params)
+        return delete(cls.__table_name__, cls, params)
 
     @classmethod
     def select_many(cls, **params) -> list[Self]:
         '''按照params的值搜索数据，返回数据列表，若没有符合的数据则返回空列表
 
         若params为空，则返回表内所有数据'''
-
-        extra = ""
-        if params:
-            where = " and ".join(
-                f"{k}={wrap(v)}"
-                for k, v in params.items()
-            )
-            extra = f"where {where}"
-
-        return select_many(cls.__table_name__, cls, extra)
+        return select_many(cls.__table_name__, cls, params)
 
     @classmethod
     def select_one(cls, **params):
-        '''按照params的值搜索数据，返回一项数据，若不存在，则自动根据params创建，创建后自动写入数据库'''
+        '''按照params的值搜索数据，返回一项数据，若不存在，则自动根据params创建，创建后自动写入数据库
+
+        params恰好为全部主键时，等同于get_or_create'''
+        if get_table(cls).is_primary_params(params):
+            return cls.get_or_create(**params)
         datas = cls.select_many(**params)
         if datas:
             return datas[0]
@@ -302,15 +985,277 @@ class AyakaDB(BaseModel):
         cls.replace(data)
         return data
 
+    @classmethod
+    def upsert(cls, keys: dict, **changes) -> None:
+        '''插入一行，若主键冲突则只更新changes中的列，其他列保持不变
+
+        参数:
+
+            keys: 主键的值
+
+            changes: 需要更新的列和值
+
+        异常:
+
+            列不存在
+        '''
+        data = cls._get_upsert_data(keys, changes)
+        upsert(cls.__table_name__, cls, data, tuple(changes))
+        cls._apply_changes(keys, {k: getattr(data, k) for k in changes})
+
+    @classmethod
+    def increment(cls, keys: dict, **deltas) -> None:
+        '''原子地令各列加上给定的值，行不存在时以默认值为基础创建
+
+        相当于 update ... set x = x + ?，不会与其他写入发生覆盖
+
+        参数:
+
+            keys: 主键的值
+
+            deltas: 列 → 增量
+
+        异常:
+
+            表没有主键，或列不存在
+        '''
+        increment(cls.__table_name__, cls, keys, deltas)
+        cls._apply_deltas(keys, deltas)
+
+    @classmethod
+    def decrement(cls, keys: dict, **deltas) -> None:
+        '''原子地令各列减去给定的值，同increment'''
+        cls.increment(keys, **{k: -v for k, v in deltas.items()})
+
+    @classmethod
+    def get_or_create(cls, **params) -> Self:
+        '''按照全部主键获取一行，若不存在则以默认值创建，不会与并发的创建发生竞争
+
+        先经由身份映射查询，只有该行不存在时才执行插入
+
+        异常:
+
+            params不是全部主键
+        '''
+        table = get_table(cls)
+        if not table.is_primary_params(params):
+            raise Exception(f"get_or_create需要且只需要提供表 {table.name} 的全部主键")
+        datas = cls.select_many(**params)
+        if datas:
+            return datas[0]
+        data = get_or_create(cls.__table_name__, cls, params)
+        table.cache_data(data)
+        return data
+
+    @classmethod
+    def _get_upsert_data(cls, keys: dict, changes: dict):
+        table = get_table(cls)
+        table.check_columns(tuple(keys))
+        table.check_columns(tuple(changes), False)
+        return cls(**keys, **changes)
+
+    @classmethod
+    def _apply_changes(cls, keys: dict, changes: dict):
+        '''令身份映射中的对象与数据库保持一致'''
+        table = get_table(cls)
+        key = table.get_cache_key(keys)
+        data = table.cache.peek(key) if key is not None else None
+        if data is not None:
+            data.__dict__.update(changes)
+            # 与__setattr__一致，丢弃尚未解码的原始数据，否则写入时会用旧值覆盖
+            for k in changes:
+                data._raw.pop(k, None)
+
+    @classmethod
+    def _apply_deltas(cls, keys: dict, deltas: dict):
+        table = get_table(cls)
+        key = table.get_cache_key(keys)
+        data = table.cache.peek(key) if key is not None else None
+        if data is not None:
+            for k, v in deltas.items():
+                data.__dict__[k] += v
+
+    @classmethod
+    def select_page(cls, order_by: str | list[str] = [], limit: int = 0, offset: int = 0, after: tuple | None = None, **params) -> list[Self]:
+        '''按照params的值搜索数据，支持排序和分页
+
+        参数:
+
+            order_by: 排序的列，列名前加"-"表示降序，为空时按主键升序
+
+            limit: 最多返回的行数，为0时不限制
+
+            offset: 跳过的行数，数据量大时建议使用after
+
+            after: 键集分页，传入上一页最后一项在各排序列上的值，只返回排在其后的数据；排序的列需能唯一确定一行，例如以主键结尾
+
+            params: 筛选条件
+
+        返回:
+
+            数据列表
+        '''
+        return select_page(cls.__table_name__, cls, params, order_by, limit, offset, after)
+
+    @classmethod
+    def iter_batches(cls, batch_size: int = 500, raw: bool = False, **params) -> Iterator[list[Self]]:
+        '''按照params的值搜索数据，按主键顺序逐批返回，内存占用与表的大小无关
+
+        参数:
+
+            batch_size: 每批的行数
+
+            raw: 为True时返回数据库中的原始行，不构造对象
+
+            params: 筛选条件
+        '''
+        return iter_batches(cls.__table_name__, cls, params, batch_size, raw)
+
+    @classmethod
+    def iterate(cls, batch_size: int = 500, raw: bool = False, **params) -> Iterator[Self]:
+        '''同iter_batches，但逐项返回'''
+        for datas in cls.iter_batches(batch_size, raw, **params):
+            yield from datas
+
+    @classmethod
+    def cache_stats(cls):
+        '''返回身份映射的命中统计，未启用时返回空字典'''
+        cache = get_table(cls).cache
+        return cache.stats() if cache is not None else {}
+
     @classmethod
     def get_db(cls):
         '''获取connection对象，通过该方法你可以自定义一些crud方法'''
         return db
 
+    @classmethod
+    def get_lock(cls):
+        '''获取保护connection对象的锁，写线程与同步API共用该connection'''
+        return db_lock
+
     def save(self):
         '''写入数据库'''
+        dirty_datas.pop(id(self), None)
+        self._dirty.clear()
         self.replace(self)
 
+    # ---- 异步API，在写线程或只读连接池中执行 ----
+    @classmethod
+    async def areplace(cls, data: Self):
+        name = cls.__table_name__
+        query, values = get_insert_args(name, data, "replace")
+        await executor.write(execute_with_table, name, cls, query, values)
+        get_table(cls).cache_data(data)
+
+    @classmethod
+    async def areplace_many(cls, datas: list[Self]):
+        name = cls.__table_name__
+        query, values = get_insert_many_args(name, datas, "replace")
+        await executor.write(execute_with_table, name, cls, query, values, True)
+        table = get_table(cls)
+        for data in datas:
+            table.cache_data(data)
+
+    @classmethod
+    async def ainsert(cls, data: Self):
+        name = cls.__table_name__
+        query, values = get_insert_args(name, data, "insert")
+        await executor.write(execute_with_table, name, cls, query, values)
+        get_table(cls).cache_data(data)
+
+    @classmethod
+    async def ainsert_many(cls, datas: list[Self]):
+        name = cls.__table_name__
+        query, values = get_insert_many_args(name, datas, "insert")
+        await executor.write(execute_with_table, name, cls, query, values, True)
+        table = get_table(cls)
+        for data in datas:
+            table.cache_data(data)
+
+    @classmethod
+    async def adelete(cls, **params):
+        '''delete的异步版本'''
+        get_table(cls).uncache(params)
+        await executor.write(delete, cls.__table_name__, cls, params)
+
+    @classmethod
+    async def aselect_many(cls, **params) -> list[Self]:
+        '''select_many的异步版本'''
+        return await aselect_many(cls.__table_name__, cls, params)
+
+    @classmethod
+    async def aselect_one(cls, **params):
+        '''select_one的异步版本'''
+        if get_table(cls).is_primary_params(params):
+            return await cls.aget_or_create(**params)
+        datas = await cls.aselect_many(**params)
+        if datas:
+            return datas[0]
+
+        # 不存在则新建
+        data = cls(**params)
+        await cls.areplace(data)
+        return data
+
+    @classmethod
+    async def aupsert(cls, keys: dict, **changes) -> None:
+        '''upsert的异步版本'''
+        data = cls._get_upsert_data(keys, changes)
+        await executor.write(upsert, cls.__table_name__, cls, data, tuple(changes))
+        cls._apply_changes(keys, {k: getattr(data, k) for k in changes})
+
+    @classmethod
+    async def aincrement(cls, keys: dict, **deltas) -> None:
+        '''increment的异步版本'''
+        await executor.write(increment, cls.__table_name__, cls, keys, deltas)
+        cls._apply_deltas(keys, deltas)
+
+    @classmethod
+    async def adecrement(cls, keys: dict, **deltas) -> None:
+        '''decrement的异步版本'''
+        await cls.aincrement(keys, **{k: -v for k, v in deltas.items()})
+
+    @classmethod
+    async def aget_or_create(cls, **params) -> Self:
+        '''get_or_create的异步版本，查询在只读连接池中执行，只有该行不存在时才交由写线程插入'''
+        table = get_table(cls)
+        if not table.is_primary_params(params):
+            raise Exception(f"get_or_create需要且只需要提供表 {table.name} 的全部主键")
+        datas = await cls.aselect_many(**params)
+        if datas:
+            return datas[0]
+        data = await executor.write(get_or_create, cls.__table_name__, cls, params)
+        table.cache_data(data)
+        return data
+
+    @classmethod
+    async def aselect_page(cls, order_by: str | list[str] = [], limit: int = 0, offset: int = 0, after: tuple | None = None, **params) -> list[Self]:
+        '''select_page的异步版本'''
+        return await aselect_page(cls.__table_name__, cls, params, order_by, limit, offset, after)
+
+    @classmethod
+    def aiter_batches(cls, batch_size: int = 500, raw: bool = False, **params) -> AsyncIterator[list[Self]]:
+        '''iter_batches的异步版本'''
+        return aiter_batches(cls.__table_name__, cls, params, batch_size, raw)
+
+    @classmethod
+    async def aiterate(cls, batch_size: int = 500, raw: bool = False, **params) -> AsyncIterator[Self]:
+        '''iterate的异步版本'''
+        async for datas in cls.aiter_batches(batch_size, raw, **params):
+            for data in datas:
+                yield data
+
+    async def asave(self):
+        '''save的异步版本'''
+        dirty_datas.pop(id(self), None)
+        self._dirty.clear()
+        await self.areplace(self)
+
+    @classmethod
+    async def aflush(cls):
+        '''flush的异步版本'''
+        await aflush()
+
 
 class AyakaGroupDB(AyakaDB):
     '''继承时要书写`__table_name__`
@@ -4,6 +4,7 @@ import datetime
 from nonebot.drivers.fastapi import FastAPIWebSocket
 from nonebot.adapters.onebot.v11.adapter import Adapter
 from .helpers import Timer, ensure_dir_exists, logger
+from .profiler import ayaka_profiler
 
 
 def hack_on_shutdown():
@@ -29,12 +30,12 @@ def hack_on_shutdown():
 def hack_load_plugin():
     '''money patch nonebot.plugin.manager PluginManager.load_plugin
 
-    令nb导入插件时，统计导入时长'''
+    令nb导入插件时，统计导入时长，并记录到启动耗时统计中'''
     from nonebot.plugin.manager import PluginManager
     origin_func = PluginManager.load_plugin
 
     def func(self, name):
-        with Timer(name):
+        with Timer(name), ayaka_profiler.measure("plugin", name):
             return origin_func(self, name)
 
     PluginManager.load_plugin = func
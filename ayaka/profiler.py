@@ -0,0 +1,95 @@
+'''启动耗时统计
+
+记录盒子创建、配置读写、数据表创建、matcher创建等启动阶段的耗时，启动完成后写入data/ayaka/startup_profile.json，也可通过命令 启动耗时 查看
+
+启动完成后不再记录，运行期间的配置读写等不会计入
+
+调用patch.hack_load_plugin后，还会记录插件导入耗时，它包含其中嵌套导入的插件，且只能统计在调用之后导入的插件
+'''
+import json
+from contextlib import contextmanager
+from time import perf_counter
+from .helpers import ensure_dir_exists
+from .lazy import Path
+
+
+class AyakaProfiler:
+    '''启动耗时统计'''
+
+    def __init__(self) -> None:
+        self.start = perf_counter()
+        '''开始统计的时间'''
+        self.ready: float | None = None
+        '''从开始统计到启动完成的耗时'''
+        self.records: dict[str, dict[str, list[float]]] = {}
+        '''类别 → 名称 → [总耗时, 次数]'''
+
+    def record(self, category: str, name: str, seconds: float):
+        '''记录一次耗时，同一类别中的同名记录累加；启动完成后忽略'''
+        if self.ready is not None:
+            return
+        items = self.records.setdefault(category, {})
+        item = items.get(name)
+        if item:
+            item[0] += seconds
+            item[1] += 1
+        else:
+            items[name] = [seconds, 1]
+
+    @contextmanager
+    def measure(self, category: str, name: str):
+        '''记录with语句块的耗时
+
+        示例代码:
+        ```
+            with ayaka_profiler.measure("plugin", "xxx"):
+                # some code...
+        ```
+        '''
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(category, name, perf_counter() - start)
+
+    def mark_ready(self):
+        '''标记启动完成'''
+        self.ready = perf_counter() - self.start
+
+    def report(self):
+        '''返回各类别的总耗时，以及按耗时降序排列的各项记录'''
+        report = {}
+        for category, items in self.records.items():
+            report[category] = {
+                "total": sum(item[0] for item in items.values()),
+                "count": sum(item[1] for item in items.values()),
+                "items": [
+                    {"name": name, "seconds": item[0], "count": item[1]}
+                    for name, item in sorted(items.items(), key=lambda x: x[1][0], reverse=True)
+                ]
+            }
+        return {"ready": self.ready, "categories": report}
+
+    def dump(self, path: str | Path):
+        '''以json格式写入文件'''
+        path = ensure_dir_exists(path)
+        with path.open("w", encoding="utf8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=4)
+
+    def summary(self, top: int = 3):
+        '''生成可读的摘要，每个类别展示耗时最长的top项'''
+        report = self.report()
+        infos = []
+        if report["ready"] is not None:
+            infos.append(f"启动完成耗时 {report['ready']:.2f}s")
+        for category, data in report["categories"].items():
+            infos.append(
+                f"[{category}] 共{data['count']}次 耗时{data['total']:.2f}s")
+            for item in data["items"][:top]:
+                infos.append(f"- {item['name']} {item['seconds']:.3f}s")
+        return "\n".join(infos)
+
+
+ayaka_profiler = AyakaProfiler()
+'''ayaka启动耗时统计'''
+
@@ -0,0 +1,186 @@
+'''盒子注册表
+
+按盒子名、所属模块、命令建立索引，并在注册命令时检测不同盒子间的命令冲突
+
+此外为各盒子的帮助建立倒排索引，可按关键词搜索所有盒子的命令名与回调说明
+'''
+from typing import TYPE_CHECKING
+from .lazy import logger
+
+if TYPE_CHECKING:
+    from .box import AyakaBox
+
+
+class AyakaCommandInfo:
+    '''一次命令注册的信息'''
+
+    __slots__ = ("box", "cmds", "states", "always")
+
+    def __init__(self, box: "AyakaBox", cmds: list[str], states: list[str], always: bool) -> None:
+        self.box = box
+        self.cmds = cmds
+        '''命令及其别名'''
+        self.states = states
+        '''命令状态，为空时意味着群聊闲置状态'''
+        self.always = always
+
+    def match_state(self, state: str):
+        '''该命令是否在盒子的指定状态下生效'''
+        return self.always or "*" in self.states or state in self.states
+
+    def conflict_with(self, other: "AyakaCommandInfo"):
+        '''两次注册是否可能被同一条群聊消息同时触发'''
+        if self.box is other.box:
+            return False
+        if self.always or other.always:
+            return True
+        # 运行中的盒子独占群聊，只有群聊闲置状态的命令才会相互冲突
+        return not self.states and not other.states
+
+
+class AyakaHelpEntry:
+    '''一条帮助'''
+
+    __slots__ = ("box", "states", "cmds", "info", "text")
+
+    def __init__(self, box: "AyakaBox", states: list[str], cmds: list[str], info: str, doc: str = "") -> None:
+        self.box = box
+        self.states = states
+        self.cmds = cmds
+        self.info = info
+        '''帮助中的一行'''
+        self.text = "\n".join([*cmds, doc]).lower()
+        '''用于搜索的文本，由命令名和回调说明组成，以换行分隔，避免关键词跨越两者匹配'''
+
+    def __str__(self) -> str:
+        return f"[{self.box.name}] {self.info}"
+
+
+class AyakaBoxRegistry:
+    '''盒子注册表'''
+
+    def __init__(self) -> None:
+        self.boxes: list["AyakaBox"] = []
+        '''按注册顺序排列的盒子'''
+        self.names: dict[str, "AyakaBox"] = {}
+        '''盒子名 → 盒子'''
+        self.modules: dict[str, list["AyakaBox"]] = {}
+        '''模块名 → 盒子'''
+        self.commands: dict[str, list[AyakaCommandInfo]] = {}
+        '''命令 → 注册信息'''
+        self.helps: list[AyakaHelpEntry] = []
+        '''按注册顺序排列的帮助'''
+        self.help_terms: dict[str, set[int]] = {}
+        '''字符 → 包含该字符的帮助序号'''
+
+    def __iter__(self):
+        return iter(self.boxes)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, name: str):
+        return name in self.names
+
+    def add(self, box: "AyakaBox"):
+        '''注册盒子
+
+        异常:
+
+            已有重名box
+        '''
+        if box.name in self.names:
+            raise Exception(f"已有重名box: {box.name}")
+        self.boxes.append(box)
+        self.names[box.name] = box
+        self.modules.setdefault(box.module_name, []).append(box)
+
+    def get(self, name: str):
+        '''获得指定名字的box，若不存在则返回None'''
+        return self.names.get(name)
+
+    def get_by_module(self, module_name: str):
+        '''获得指定模块中创建的所有box'''
+        return self.modules.get(module_name, [])
+
+    def add_command(self, box: "AyakaBox", cmds: list[str], states: list[str], always: bool):
+        '''登记命令，若与其他盒子的命令冲突则发出警告'''
+        info = AyakaCommandInfo(box, cmds, states, always)
+        for cmd in cmds:
+            infos = self.commands.setdefault(cmd, [])
+            for other in infos:
+                if info.conflict_with(other):
+                    logger.opt(colors=True).warning(
+                        f"盒子 <c>{box.name}</c> 与盒子 <c>{other.box.name}</c> 的命令 <y>{cmd}</y> 冲突")
+            infos.append(info)
+
+    def add_help(self, box: "AyakaBox", states: list[str], cmds: list[str], info: str, doc: str = ""):
+        '''登记一条帮助，以命令名和回调说明中的每个字符建立倒排索引，以便搜索不含空格的中文
+
+        参数:
+
+            info: 帮助中展示的一行
+
+            doc: 回调说明
+        '''
+        entry = AyakaHelpEntry(box, states, cmds, info, doc)
+        i = len(self.helps)
+        self.helps.append(entry)
+        for char in set(entry.text):
+            if not char.isspace():
+                self.help_terms.setdefault(char, set()).add(i)
+
+    def search_help(self, keyword: str):
+        '''搜索命令名或回调说明中包含关键词的帮助
+
+        参数:
+
+            keyword: 关键词，不区分大小写
+
+        返回:
+
+            按注册顺序排列的帮助列表
+        '''
+        keyword = keyword.strip().lower()
+        chars = {char for char in keyword if not char.isspace()}
+        if not chars:
+            return []
+
+        # 先以最少的候选开始求交集，再逐个确认是否包含完整的关键词
+        postings = sorted(
+            (self.help_terms.get(char, set()) for char in chars), key=len)
+        ids = set(postings[0])
+        for posting in postings[1:]:
+            ids &= posting
+            if not ids:
+                return []
+        return [
+            self.helps[i] for i in sorted(ids)
+            if keyword in self.helps[i].text
+        ]
+
+    def lookup(self, cmd: str, state: str | None = None, box_name: str | None = None):
+        '''查询处理指定命令的注册信息
+
+        参数:
+
+            cmd: 命令或其别名
+
+            state: 盒子状态，为空时不按状态筛选
+
+            box_name: 盒子名，为空时不按盒子筛选
+
+        返回:
+
+            注册信息列表
+        '''
+        infos = self.commands.get(cmd, [])
+        if box_name is not None:
+            infos = [i for i in infos if i.box.name == box_name]
+        if state is not None:
+            infos = [i for i in infos if i.match_state(state)]
+        return infos
+
+
+box_registry = AyakaBoxRegistry()
+'''盒子注册表'''
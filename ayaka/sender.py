@@ -0,0 +1,294 @@
+'''消息发送队列
+
+启用根配置的send_queue后，box.send等方法将消息放入所在群聊的队列，由该群聊的工作协程按顺序发送，回调无需等待发送完成即可结束
+
+每个群聊、每个bot各有一个令牌桶，限制发送速率，避免短时间内大量发送触发风控
+
+此外，盒子或回调可以启用发送缓冲，同一事件中的多次box.send将在回调结束后合并为一条消息发送
+'''
+import asyncio
+from collections import deque
+from time import monotonic
+from typing import Any
+from nonebot.matcher import Matcher, current_event
+from nonebot.message import run_postprocessor
+from .config import ayaka_root_config
+from .helpers import pack_messages
+from .lazy import Bot, GroupMessageEvent, Message, MessageSegment, get_driver, logger
+
+SEND_BUFFER_KEY = "ayaka_send_buffer"
+'''发送缓冲保存在matcher.state中的键'''
+
+
+class TokenBucket:
+    '''令牌桶
+
+    参数:
+
+        rate: 每秒补充的令牌数，为0时不限制
+
+        capacity: 令牌数上限，即允许的突发数量
+    '''
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self.tokens = float(self.capacity)
+        self.time = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.time) * self.rate)
+        self.time = now
+
+    @property
+    def full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        '''取得一个令牌，令牌不足时等待'''
+        if self.rate <= 0:
+            return
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AyakaSendItem:
+    '''等待发送的消息'''
+    __slots__ = ("bot", "api", "data", "future", "time")
+
+    def __init__(self, bot: Bot, api: str, data: dict, future: asyncio.Future | None) -> None:
+        self.bot = bot
+        self.api = api
+        self.data = data
+        self.future = future
+        self.time = monotonic()
+
+
+class AyakaSender:
+    '''消息发送队列'''
+
+    def __init__(self) -> None:
+        self.queues: dict[tuple[str, int], deque[AyakaSendItem]] = {}
+        '''(bot id, 群聊) → 待发送的消息'''
+        self.workers: dict[tuple[str, int], asyncio.Task] = {}
+        '''(bot id, 群聊) → 工作协程，队列为空时退出'''
+        self.group_buckets: dict[tuple[str, int], TokenBucket] = {}
+        self.bot_buckets: dict[str, TokenBucket] = {}
+
+        self.sent = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def depth(self):
+        '''当前排队的消息数'''
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, bot: Bot, group_id: int, api: str, data: dict, wait: bool = False):
+        '''将消息放入群聊的队列
+
+        参数:
+
+            bot: 发送消息的bot
+
+            group_id: 群聊
+
+            api: OneBot API
+
+            data: API参数
+
+            wait: 是否返回可等待发送结果的future
+
+        返回:
+
+            wait为True时返回future，否则返回None
+        '''
+        future = asyncio.get_running_loop().create_future() if wait else None
+        key = (bot.self_id, group_id)
+        queue = self.queues.setdefault(key, deque())
+        queue.append(AyakaSendItem(bot, api, data, future))
+        self.max_depth = max(self.max_depth, len(queue))
+
+        if key not in self.workers:
+            self.workers[key] = asyncio.create_task(self._work(key))
+        return future
+
+    async def send(self, bot: Bot, group_id: int, api: str, data: dict, wait: bool = False) -> Any:
+        '''将消息放入群聊的队列，wait为True时等待发送完成并返回API的结果'''
+        future = self.put(bot, group_id, api, data, wait)
+        if future:
+            return await future
+
+    def _get_bucket(self, key: tuple[str, int]):
+        bucket = self.group_buckets.get(key)
+        if not bucket:
+            bucket = TokenBucket(
+                ayaka_root_config.send_group_rate,
+                ayaka_root_config.send_group_burst
+            )
+            self.group_buckets[key] = bucket
+        return bucket
+
+    def _get_bot_bucket(self, bot_id: str):
+        bucket = self.bot_buckets.get(bot_id)
+        if not bucket:
+            bucket = TokenBucket(
+                ayaka_root_config.send_bot_rate,
+                ayaka_root_config.send_bot_burst
+            )
+            self.bot_buckets[bot_id] = bucket
+        return bucket
+
+    async def _work(self, key: tuple[str, int]):
+        queue = self.queues[key]
+        bucket = self._get_bucket(key)
+        bot_bucket = self._get_bot_bucket(key[0])
+        try:
+            while queue:
+                await bucket.acquire()
+                await bot_bucket.acquire()
+                await self._send(queue.popleft())
+        finally:
+            self.workers.pop(key, None)
+            if not queue:
+                self.queues.pop(key, None)
+            # 令牌已补满的桶与新建的桶没有区别，不再保留
+            if bucket.full:
+                self.group_buckets.pop(key, None)
+
+    async def _send(self, item: AyakaSendItem):
+        try:
+            result = await item.bot.call_api(item.api, **item.data)
+        except Exception as e:
+            self.failed += 1
+            if item.future:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            else:
+                logger.opt(exception=e, colors=True).error(
+                    f"发送消息失败 <r>{item.api}</r>")
+            return
+
+        latency = monotonic() - item.time
+        self.sent += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        if item.future and not item.future.done():
+            item.future.set_result(result)
+
+    async def join(self, timeout: float = 5):
+        '''等待所有排队的消息发送完毕，超时后取消剩余的消息'''
+        workers = list(self.workers.values())
+        if workers:
+            _, pending = await asyncio.wait(workers, timeout=timeout)
+            for task in pending:
+                task.cancel()
+        dropped = self.depth
+        if dropped:
+            logger.opt(colors=True).warning(
+                f"已丢弃 <r>{dropped}</r> 条未发送的消息")
+        for queue in self.queues.values():
+            for item in queue:
+                if item.future and not item.future.done():
+                    item.future.cancel()
+        self.queues.clear()
+
+    def stats(self):
+        '''返回队列深度、发送数量与延迟的统计'''
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "groups": len(self.queues),
+            "sent": self.sent,
+            "failed": self.failed,
+            "avg_latency": self.total_latency / self.sent if self.sent else 0,
+            "max_latency": self.max_latency,
+        }
+
+
+ayaka_sender = AyakaSender()
+'''ayaka消息发送队列'''
+
+
+@get_driver().on_shutdown
+async def join_sender():
+    '''关闭前尽量发送完排队的消息'''
+    await ayaka_sender.join()
+
+
+async def send_group_msg(bot: Bot, event: GroupMessageEvent, message: Message | MessageSegment | str, wait: bool | None = None):
+    '''发送群聊消息，启用发送队列时放入队列
+
+    参数:
+
+        wait: 启用发送队列时，是否等待发送完成，为None时使用根配置的send_wait
+
+    返回:
+
+        API的结果，不等待发送完成时返回None
+    '''
+    if not ayaka_root_config.send_queue:
+        return await bot.send(event, message)
+    if wait is None:
+        wait = ayaka_root_config.send_wait
+    data = {"group_id": event.group_id, "message": Message(message)}
+    return await ayaka_sender.send(bot, event.group_id, "send_group_msg", data, wait)
+
+
+async def send_group_forward_msg(bot: Bot, group_id: int, messages: list[dict], wait: bool | None = None):
+    '''发送群聊合并转发消息，启用发送队列时放入队列'''
+    if not ayaka_root_config.send_queue:
+        return await bot.send_group_forward_msg(group_id=group_id, messages=messages)
+    if wait is None:
+        wait = ayaka_root_config.send_wait
+    data = {"group_id": group_id, "messages": messages}
+    return await ayaka_sender.send(bot, group_id, "send_group_forward_msg", data, wait)
+
+
+async def flush_send_buffer(bot: Bot, event: GroupMessageEvent, state: dict):
+    '''发送缓冲中的消息
+
+    合并后的长度不超过根配置的send_buffer_threshold时，以换行连接为一条消息，否则以合并转发消息发送
+    '''
+    messages: list = state.pop(SEND_BUFFER_KEY, None)
+    if not messages:
+        return
+
+    message = Message()
+    for i, m in enumerate(messages):
+        if i:
+            message += "\n"
+        message += m
+
+    threshold = ayaka_root_config.send_buffer_threshold
+    if len(messages) == 1 or not threshold or len(str(message)) <= threshold:
+        await send_group_msg(bot, event, message)
+        return
+
+    # 合并转发消息不可超过100条
+    for i in range(0, len(messages), 100):
+        msgs = pack_messages(
+            user_id=int(bot.self_id),
+            user_name="Ayaka Bot",
+            messages=messages[i: i+100]
+        )
+        await send_group_forward_msg(bot, event.group_id, msgs)
+
+
+@run_postprocessor
+async def flush_send_buffer_after_handler(matcher: Matcher, bot: Bot):
+    '''回调结束后，发送本次事件中被缓冲的消息'''
+    if SEND_BUFFER_KEY not in matcher.state:
+        return
+    event = current_event.get()
+    if isinstance(event, GroupMessageEvent):
+        await flush_send_buffer(bot, event, matcher.state)
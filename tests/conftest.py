@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+import nonebot
+
+# ayaka在导入时于当前目录下创建data/ayaka，测试在临时目录中进行
+os.chdir(tempfile.mkdtemp())
+nonebot.init()
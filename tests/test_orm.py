@@ -0,0 +1,56 @@
+from ayaka.orm import AyakaDB, JsonKey, PrimaryKey, execute, get_table
+from ayaka.lazy import Field
+
+
+class StrData(AyakaDB):
+    __table_name__ = "test_str_data"
+    key: str = Field(extra=PrimaryKey)
+    value: str = ""
+
+
+class CachedJsonData(AyakaDB):
+    __table_name__ = "test_cached_json_data"
+    __cache_size__ = 10
+    key: int = Field(extra=PrimaryKey)
+    data: dict = Field(extra=JsonKey, default_factory=dict)
+    count: int = 0
+
+
+class LegacyStrData(AyakaDB):
+    __table_name__ = "test_legacy_str_data"
+    key: str = Field(extra=PrimaryKey)
+    value: str = ""
+
+
+def test_numeric_strings_round_trip():
+    assert get_table(StrData).trusted
+    StrData.replace_many([
+        StrData(key="007", value="2048"),
+        StrData(key="1.50", value="1e3"),
+    ])
+    datas = {data.key: data.value for data in StrData.select_many()}
+    assert datas == {"007": "2048", "1.50": "1e3"}
+    assert StrData.select_one(key="007").value == "2048"
+
+
+def test_legacy_string_columns():
+    # 旧版以string声明列，sqlite将数字形式的文本存为整数
+    execute(
+        "create table if not exists test_legacy_str_data (key string, value string, PRIMARY KEY(\"key\"))")
+    LegacyStrData.replace(LegacyStrData(key="2048", value="42"))
+    data, = LegacyStrData.select_many()
+    assert (data.key, data.value) == ("2048", "42")
+
+
+def test_upsert_json_column_on_cached_object():
+    CachedJsonData.replace(CachedJsonData(key=1, data={"a": 1}))
+    get_table(CachedJsonData).cache.clear()
+
+    # 尚未解码json列的缓存对象
+    data = CachedJsonData.select_one(key=1)
+    CachedJsonData.upsert({"key": 1}, data={"b": 2})
+    data.count = 1
+
+    get_table(CachedJsonData).cache.clear()
+    data = CachedJsonData.select_one(key=1)
+    assert (data.data, data.count) == ({"b": 2}, 1)